@@ -0,0 +1,80 @@
+"""
+Minimal standalone django project used by the benchmark scripts.
+
+The scripts are run from the repository root, e.g. "python benchmarks/bench_shared_instances.py",
+against an in-memory SQLite database and the locmem email backend.
+"""
+import logging
+import os
+import sys
+
+import django
+from django.conf import settings
+from django.core.management import call_command
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def setup(**overrides):
+    """
+    Configures django with the app installed, creates the tables and returns the settings.
+    """
+    configs = dict(
+        SECRET_KEY="benchmark-secret-key",
+        DEBUG=False,
+        ALLOWED_HOSTS=["testserver"],
+        INSTALLED_APPS=[
+            "django.contrib.auth",
+            "django.contrib.contenttypes",
+            "django.contrib.sessions",
+            "django.contrib.messages",
+            "verify_email.apps.VerifyEmailConfig",
+        ],
+        MIDDLEWARE=[
+            "django.contrib.sessions.middleware.SessionMiddleware",
+            "django.middleware.csrf.CsrfViewMiddleware",
+            "django.contrib.auth.middleware.AuthenticationMiddleware",
+            "django.contrib.messages.middleware.MessageMiddleware",
+        ],
+        DATABASES={
+            "default": {"ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}
+        },
+        ROOT_URLCONF="_urls",
+        TEMPLATES=[
+            {
+                "BACKEND": "django.template.backends.django.DjangoTemplates",
+                "APP_DIRS": True,
+                "OPTIONS": {
+                    "context_processors": [
+                        "django.template.context_processors.request",
+                        "django.contrib.messages.context_processors.messages",
+                    ]
+                },
+            }
+        ],
+        EMAIL_BACKEND="django.core.mail.backends.locmem.EmailBackend",
+        PASSWORD_HASHERS=["django.contrib.auth.hashers.MD5PasswordHasher"],
+        DEFAULT_AUTO_FIELD="django.db.models.BigAutoField",
+        LOGIN_URL="accounts_login",
+        USE_TZ=True,
+    )
+    configs.update(overrides)
+    settings.configure(**configs)
+    django.setup()
+    # the failure paths log every error, keep the output readable
+    logging.disable(logging.CRITICAL)
+    call_command("migrate", verbosity=0)
+    return settings
+
+
+def create_inactive_user(username, email=None):
+    from django.contrib.auth import get_user_model
+
+    user = get_user_model().objects.create_user(
+        username=username,
+        email=email or f"{username}@example.com",
+        password="benchmark",
+    )
+    user.is_active = False
+    user.save()
+    return user
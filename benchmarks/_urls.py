@@ -0,0 +1,7 @@
+from django.http import HttpResponse
+from django.urls import include, path
+
+urlpatterns = [
+    path("verification/", include("verify_email.urls")),
+    path("login/", lambda request: HttpResponse("login"), name="accounts_login"),
+]
@@ -0,0 +1,80 @@
+"""
+Compares email lookup latency on the user table, in SQLite:
+    - exact "email = ..."           (what the app did, no index on auth_user.email)
+    - "LOWER(email) = LOWER(...)"   without index
+    - "LOWER(email) = LOWER(...)"   with the functional index of VERIFY_EMAIL_CASE_INSENSITIVE_EMAIL
+
+    python benchmarks/bench_email_lookup.py [--rows 1000000] [--lookups 200]
+"""
+import argparse
+import random
+import time
+
+from _setup import setup
+
+
+def populate(rows, batch_size=20000):
+    from django.contrib.auth import get_user_model
+
+    user_model = get_user_model()
+    for start in range(0, rows, batch_size):
+        user_model.objects.bulk_create(
+            user_model(
+                username=f"user{i}",
+                email=f"User{i}@Example.com",
+                password="!",
+                is_active=False,
+            )
+            for i in range(start, min(start + batch_size, rows))
+        )
+
+
+def measure(lookup, emails):
+    start = time.perf_counter()
+    for email in emails:
+        assert lookup(email) is not None
+    return (time.perf_counter() - start) / len(emails) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=200)
+    args = parser.parse_args()
+
+    setup()
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+    from django.test import override_settings
+
+    from verify_email.models import add_lower_email_index
+    from verify_email.token_manager import filter_users_by_email
+
+    print(f"creating {args.rows} users...")
+    populate(args.rows)
+
+    indexes = random.Random(0).sample(range(args.rows), min(args.lookups, args.rows))
+    exact_emails = [f"User{i}@Example.com" for i in indexes]
+    lowered_emails = [email.lower() for email in exact_emails]
+    user_model = get_user_model()
+
+    exact = measure(
+        lambda email: user_model.objects.filter(email=email).first(), exact_emails
+    )
+    with override_settings(VERIFY_EMAIL_CASE_INSENSITIVE_EMAIL=True):
+        lower_scan = measure(
+            lambda email: filter_users_by_email(email).first(), lowered_emails
+        )
+        with connection.schema_editor() as schema_editor:
+            add_lower_email_index(schema_editor, user_model)
+        lower_indexed = measure(
+            lambda email: filter_users_by_email(email).first(), lowered_emails
+        )
+
+    print(f"{'email = ... (no index)':<32} {exact:10.3f} ms/lookup")
+    print(f"{'LOWER(email) (no index)':<32} {lower_scan:10.3f} ms/lookup")
+    print(f"{'LOWER(email) (functional index)':<32} {lower_indexed:10.3f} ms/lookup")
+
+
+if __name__ == "__main__":
+    main()
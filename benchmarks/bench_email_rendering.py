@@ -0,0 +1,82 @@
+"""
+Compares building a verification email with render_to_string + strip_tags on every message
+(the previous behaviour) against the compiled template and the cached plain-text part of
+ActivationMailManager, and against a plain-text template (VERIFY_EMAIL_TEXT_MESSAGE_TEMPLATE).
+
+    python benchmarks/bench_email_rendering.py [--messages N]
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from _setup import create_inactive_user, setup
+
+TEXT_TEMPLATE = "Please verify your e-mail by opening this link: {{ link }}\n"
+
+
+def previous(manager, links, user):
+    from django.core.mail import EmailMultiAlternatives
+    from django.template.loader import render_to_string
+    from django.utils.html import strip_tags
+
+    for link in links:
+        msg = render_to_string(
+            manager.settings.html_message_template,
+            {"link": link, "inactive_user": user},
+        )
+        message = EmailMultiAlternatives(
+            manager.settings.subject, strip_tags(msg), to=[user.email]
+        )
+        message.attach_alternative(msg, "text/html")
+
+
+def current(manager, links, user):
+    for link in links:
+        manager._build_message(
+            manager._render_message(link, inactive_user=user), user.email
+        )
+
+
+def measure(fn, manager, links, user):
+    fn(manager, links[:10], user)  # warm up
+    start = time.perf_counter()
+    fn(manager, links, user)
+    return len(links) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=2000)
+    args = parser.parse_args()
+
+    template_dir = tempfile.mkdtemp()
+    with open(os.path.join(template_dir, "verification.txt"), "w") as template:
+        template.write(TEXT_TEMPLATE)
+
+    settings = setup()
+    settings.TEMPLATES[0]["DIRS"] = [template_dir]
+    from django.test import override_settings
+
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.email_handler import ActivationMailManager
+
+    user = create_inactive_user("benchmark")
+    links = [f"/verify-email/{i:08d}/token-{i}/" for i in range(args.messages)]
+
+    manager = get_shared_instance(ActivationMailManager)
+    results = {
+        "render + strip_tags": measure(previous, manager, links, user),
+        "cached plain text": measure(current, manager, links, user),
+    }
+    with override_settings(VERIFY_EMAIL_TEXT_MESSAGE_TEMPLATE="verification.txt"):
+        manager = get_shared_instance(ActivationMailManager)
+        results["plain-text template"] = measure(current, manager, links, user)
+
+    before = results["render + strip_tags"]
+    for name, rate in results.items():
+        print(f"{name:<22} {rate:9.0f} messages/s   x{rate / before:5.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Compares the verify path with a new UserActivationProcess / TokenManager built for every request
+(the previous behaviour) against the shared instances returned by "get_shared_instance".
+
+    python benchmarks/bench_shared_instances.py [--iterations N]
+"""
+import argparse
+import time
+import tracemalloc
+
+from _setup import create_inactive_user, setup
+
+
+def per_request_instance():
+    from verify_email.confirm import UserActivationProcess
+    from verify_email.token_manager import ActivationLinkManager, TokenManager
+
+    return UserActivationProcess(
+        token_manager=TokenManager(link_manager=ActivationLinkManager())
+    )
+
+
+def shared_instance():
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.confirm import UserActivationProcess
+
+    return get_shared_instance(UserActivationProcess)
+
+
+def measure(factory, encoded_email, encoded_token, iterations):
+    def verify():
+        factory().token_manager.decrypt_token_and_get_user(encoded_email, encoded_token)
+
+    verify()  # warm up
+
+    start = time.process_time()
+    for _ in range(iterations):
+        verify()
+    cpu_us = (time.process_time() - start) / iterations * 1e6
+
+    tracemalloc.start()
+    peaks = []
+    for _ in range(min(iterations, 200)):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        verify()
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return cpu_us, sum(peaks) / len(peaks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    setup()
+    from verify_email.token_manager import SafeURL, TokenManager
+
+    user = create_inactive_user("benchmark")
+    encoded_token = TokenManager().generate_token_for_user(user)
+    encoded_email = SafeURL.perform_encoding(user.email)
+
+    results = {}
+    for name, factory in (
+        ("per-request instance", per_request_instance),
+        ("shared instance", shared_instance),
+    ):
+        results[name] = measure(factory, encoded_email, encoded_token, args.iterations)
+        cpu_us, peak_bytes = results[name]
+        print(f"{name:<22} {cpu_us:9.1f} us/verify   {peak_bytes / 1024:7.1f} KiB peak/verify")
+
+    for name, factory in (
+        ("per-request instance", per_request_instance),
+        ("shared instance", shared_instance),
+    ):
+        start = time.process_time()
+        for _ in range(args.iterations):
+            factory()
+        cpu_us = (time.process_time() - start) / args.iterations * 1e6
+        print(f"{name:<22} {cpu_us:9.1f} us/instance lookup or build")
+
+    before, after = results["per-request instance"], results["shared instance"]
+    print(
+        f"{'verify drop':<22} {100 * (1 - after[0] / before[0]):8.1f} % cpu   "
+        f"{100 * (1 - after[1] / before[1]):11.1f} % memory"
+    )
+
+
+if __name__ == "__main__":
+    main()
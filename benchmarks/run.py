@@ -0,0 +1,375 @@
+"""
+Micro-benchmark suite of the token and mail hot paths, against SQLite and the locmem email backend.
+
+Every benchmark is run "--repeat" times over "--iterations" calls, the results are written as JSON
+(per call timings in microseconds) so that two runs can be compared:
+
+    python benchmarks/run.py --output before.json
+    python benchmarks/run.py --compare before.json --threshold 0.2
+
+With "--compare", the benchmarks whose median got slower than the baseline by more than the
+threshold are listed and the exit status is 1.
+"""
+import argparse
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+from unittest import mock
+
+from _setup import setup
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """
+    Registers a benchmark. The decorated function gets the number of iterations, prepares
+    whatever the calls need and returns the function to time, called with the iteration index.
+    """
+
+    def register(prepare):
+        BENCHMARKS[name] = prepare
+        return prepare
+
+    return register
+
+
+def create_users(prefix, count):
+    from django.contrib.auth import get_user_model
+
+    from verify_email.token_manager import ActivationLinkManager
+
+    user_model = get_user_model()
+    start = user_model.objects.count()
+    users = user_model.objects.bulk_create(
+        user_model(
+            username=f"{prefix}{i}",
+            email=f"{prefix}{i}@example.com",
+            password="!",
+            is_active=False,
+        )
+        for i in range(start, start + count)
+    )
+    users = list(user_model.objects.filter(pk__in=[user.pk for user in users]))
+    # as if a link had been sent, the verification looks them up through the pending table
+    ActivationLinkManager().register_pending_verifications(users)
+    return users
+
+
+def expired_token(user):
+    from django.core import signing
+
+    from verify_email.token_manager import TokenManager
+
+    # signed two days ago, EXPIRE_AFTER is one day
+    with mock.patch.object(signing.time, "time", return_value=time.time() - 2 * 86400):
+        return TokenManager().generate_token_for_user(user)
+
+
+def encoded_link_parts(user, token):
+    from verify_email.token_manager import SafeURL
+
+    return SafeURL.perform_encoding(user.email), token
+
+
+@benchmark("token.generate")
+def bench_generate_token(iterations):
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.token_manager import TokenManager
+
+    manager = get_shared_instance(TokenManager)
+    user = create_users("generate", 1)[0]
+    return lambda i: manager.generate_token_for_user(user)
+
+
+@benchmark("token.generate.batch")
+def bench_generate_tokens_batch(iterations):
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.token_manager import TokenManager
+
+    manager = get_shared_instance(TokenManager)
+    user = create_users("batch", 1)[0]
+    batch = manager.generate_tokens_for_users(user for _ in range(iterations))
+    return lambda i: next(batch)
+
+
+@benchmark("token.decrypt.valid")
+def bench_decrypt_valid(iterations):
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.token_manager import TokenManager
+
+    manager = get_shared_instance(TokenManager)
+    user = create_users("valid", 1)[0]
+    email, token = encoded_link_parts(user, manager.generate_token_for_user(user))
+    return lambda i: manager.decrypt_token_and_get_user(email, token)
+
+
+@benchmark("token.decrypt.compact")
+def bench_decrypt_compact(iterations):
+    from django.test.utils import override_settings
+
+    from verify_email.token_manager import COMPACT_LINK_MARKER, TokenManager
+
+    with override_settings(VERIFY_EMAIL_LINK_FORMAT="compact"):
+        manager = TokenManager()
+    user = create_users("compact", 1)[0]
+    token = manager.compact_signer.make_token(user)
+    return lambda i: manager.decrypt_token_and_get_user(COMPACT_LINK_MARKER, token)
+
+
+@benchmark("token.decrypt.expired")
+def bench_decrypt_expired(iterations):
+    from django.core.signing import SignatureExpired
+
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.token_manager import TokenManager
+
+    manager = get_shared_instance(TokenManager)
+    user = create_users("expired", 1)[0]
+    email, token = encoded_link_parts(user, expired_token(user))
+
+    def run(i):
+        try:
+            manager.decrypt_token_and_get_user(email, token)
+        except SignatureExpired:
+            return
+        raise AssertionError("the link should be expired")
+
+    return run
+
+
+@benchmark("token.decrypt.bad_signature")
+def bench_decrypt_bad_signature(iterations):
+    from django.core.signing import BadSignature
+
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.token_manager import SafeURL, TokenManager
+
+    manager = get_shared_instance(TokenManager)
+    user = create_users("bad", 1)[0]
+    signed = manager.generate_token_for_user(user, get_url_encoded=False)
+    email, token = encoded_link_parts(user, SafeURL.perform_encoding(signed[:-1] + "x"))
+
+    def run(i):
+        try:
+            manager.decrypt_token_and_get_user(email, token)
+        except BadSignature:
+            return
+        raise AssertionError("the signature should be rejected")
+
+    return run
+
+
+@benchmark("safe_url.encode")
+def bench_safe_url_encode(iterations):
+    from verify_email.token_manager import SafeURL
+
+    return lambda i: SafeURL.perform_encoding("someone.with.a.long.name@example.com")
+
+
+@benchmark("safe_url.decode")
+def bench_safe_url_decode(iterations):
+    from verify_email.token_manager import SafeURL
+
+    encoded = SafeURL.perform_encoding("someone.with.a.long.name@example.com")
+    return lambda i: SafeURL.perform_decoding(encoded)
+
+
+@benchmark("mail.send_verification_link")
+def bench_send_verification_link(iterations):
+    from django.core import mail
+
+    from verify_email.email_handler import ActivationMailManager
+
+    users = create_users("send", iterations)
+
+    def run(i):
+        ActivationMailManager.send_verification_link(users[i])
+        mail.outbox.clear()
+
+    return run
+
+
+@benchmark("view.verify.success")
+def bench_view_verify_success(iterations):
+    from django.test import Client
+
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.token_manager import ActivationLinkManager, TokenManager
+
+    manager = get_shared_instance(TokenManager)
+    client = Client()
+    links = [
+        ActivationLinkManager.generate_link(manager.generate_token_for_user(user), user.email)
+        for user in create_users("view", iterations)
+    ]
+
+    def run(i):
+        assert client.get(links[i]).status_code in (200, 302)
+
+    return run
+
+
+@benchmark("view.verify.expired")
+def bench_view_verify_expired(iterations):
+    from django.test import Client
+
+    from verify_email.token_manager import ActivationLinkManager
+
+    client = Client()
+    user = create_users("viewexpired", 1)[0]
+    link = ActivationLinkManager.generate_link(expired_token(user), user.email)
+
+    def run(i):
+        assert client.get(link).status_code == 401
+
+    return run
+
+
+@benchmark("view.verify.invalid")
+def bench_view_verify_invalid(iterations):
+    from django.test import Client
+    from django.urls import reverse
+
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.token_manager import SafeURL, TokenManager
+
+    client = Client()
+    user = create_users("viewinvalid", 1)[0]
+    email = SafeURL.perform_encoding(user.email)
+    manager = get_shared_instance(TokenManager)
+    # correctly signed, but not tokens of this user; a new link every call, a repeated one
+    # would be answered by the negative cache without decoding it
+    links = [
+        reverse(
+            "verify-email",
+            args=[email, SafeURL.perform_encoding(manager.sign(f"invalid-token-{i}"))],
+        )
+        for i in range(iterations)
+    ]
+
+    def run(i):
+        assert client.get(links[i]).status_code == 401
+
+    return run
+
+
+@benchmark("view.verify.invalid.repeated")
+def bench_view_verify_invalid_repeated(iterations):
+    from django.test import Client
+    from django.urls import reverse
+
+    from verify_email.app_configurations import get_shared_instance
+    from verify_email.token_manager import SafeURL, TokenManager
+
+    client = Client()
+    user = create_users("viewrepeated", 1)[0]
+    token = SafeURL.perform_encoding(get_shared_instance(TokenManager).sign("invalid-token"))
+    link = reverse("verify-email", args=[SafeURL.perform_encoding(user.email), token])
+
+    # answered by the negative cache after the first call
+    def run(i):
+        assert client.get(link).status_code == 401
+
+    return run
+
+
+def measure(prepare, iterations, repeat):
+    timings = []
+    for _ in range(repeat):
+        run = prepare(iterations)
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            for i in range(iterations):
+                run(i)
+            timings.append((time.perf_counter() - start) / iterations * 1e6)
+        finally:
+            gc.enable()
+    median = statistics.median(timings)
+    return {
+        "iterations": iterations,
+        "repeat": repeat,
+        "median_us": round(median, 3),
+        "min_us": round(min(timings), 3),
+        "max_us": round(max(timings), 3),
+        "stdev_us": round(statistics.stdev(timings), 3) if repeat > 1 else 0.0,
+        "ops_per_sec": round(1e6 / median, 1),
+    }
+
+
+def environment():
+    import django
+
+    return {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "django": django.get_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns the benchmarks slower than the baseline by more than "threshold" (0.2 is 20%).
+    """
+    regressions = {}
+    for name, result in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        change = result["median_us"] / previous["median_us"] - 1
+        if change > threshold:
+            regressions[name] = round(change, 3)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--filter", default="", help="Only run the benchmarks whose name contains this."
+    )
+    parser.add_argument("--output", help="Write the JSON results to this file.")
+    parser.add_argument("--compare", help="JSON results of a previous run.")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    setup(EXPIRE_AFTER="1d", MAX_RETRIES=2)
+
+    results = {}
+    for name, prepare in BENCHMARKS.items():
+        if args.filter in name:
+            results[name] = measure(prepare, args.iterations, args.repeat)
+            print(
+                f"{name:<32} {results[name]['median_us']:10.1f} us/call",
+                file=sys.stderr,
+            )
+
+    report = {"environment": environment(), "results": results}
+    if args.compare:
+        with open(args.compare) as baseline:
+            report["regressions"] = compare(results, json.load(baseline), args.threshold)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
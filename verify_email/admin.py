@@ -1,4 +1,5 @@
 from django.contrib import admin
-from .models import LinkCounter
+from .models import LinkCounter, OutboxMessage
 
 admin.site.register(LinkCounter)
+admin.site.register(OutboxMessage)
@@ -1,8 +1,17 @@
-from dataclasses import dataclass
+import threading
+from dataclasses import dataclass, fields
+from datetime import timedelta
+from typing import Any, Dict, Optional, Tuple, Type, TypeVar, Union
 
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from .errors import WrongTimeInterval
 from .interface import DefaultConfig
 
+TIME_UNITS = ["s", "m", "h", "d"]
+
+T = TypeVar("T")
+
 
 @dataclass
 class GetFieldFromSettings:
@@ -34,6 +43,9 @@ class GetFieldFromSettings:
                 setting_field="HTML_MESSAGE_TEMPLATE",
                 default_value="verify_email/email_verification_msg.html",
             ),
+            "text_message_template": DefaultConfig(
+                setting_field="VERIFY_EMAIL_TEXT_MESSAGE_TEMPLATE", default_value=None
+            ),
             "from_alias": DefaultConfig(
                 setting_field="DEFAULT_FROM_EMAIL",
                 default_value="<noreply<noreply@gmail.com>",
@@ -77,6 +89,79 @@ class GetFieldFromSettings:
             "key": DefaultConfig(setting_field="HASHING_KEY", default_value=None),
             "max_age": DefaultConfig(setting_field="EXPIRE_AFTER", default_value=None),
             "max_retries": DefaultConfig(setting_field="MAX_RETRIES", default_value=2),
+            "dispatch": DefaultConfig(
+                setting_field="VERIFY_EMAIL_DISPATCH", default_value="sync"
+            ),
+            "dispatch_workers": DefaultConfig(
+                setting_field="VERIFY_EMAIL_DISPATCH_WORKERS", default_value=4
+            ),
+            "dispatch_queue_size": DefaultConfig(
+                setting_field="VERIFY_EMAIL_DISPATCH_QUEUE_SIZE", default_value=100
+            ),
+            "dispatch_backpressure": DefaultConfig(
+                setting_field="VERIFY_EMAIL_DISPATCH_BACKPRESSURE",
+                default_value="block",
+            ),
+            "email_pool_backend": DefaultConfig(
+                setting_field="VERIFY_EMAIL_POOL_BACKEND",
+                default_value="django.core.mail.backends.smtp.EmailBackend",
+            ),
+            "email_pool_size": DefaultConfig(
+                setting_field="VERIFY_EMAIL_POOL_SIZE", default_value=4
+            ),
+            "email_pool_max_messages": DefaultConfig(
+                setting_field="VERIFY_EMAIL_POOL_MAX_MESSAGES", default_value=100
+            ),
+            "email_pool_max_age": DefaultConfig(
+                setting_field="VERIFY_EMAIL_POOL_MAX_AGE", default_value="5m"
+            ),
+            "case_insensitive_email": DefaultConfig(
+                setting_field="VERIFY_EMAIL_CASE_INSENSITIVE_EMAIL",
+                default_value=False,
+            ),
+            "cache_pages": DefaultConfig(
+                setting_field="VERIFY_EMAIL_CACHE_PAGES", default_value=False
+            ),
+            "rate_limit_ip": DefaultConfig(
+                setting_field="VERIFY_EMAIL_RATE_LIMIT_IP", default_value=None
+            ),
+            "rate_limit_email": DefaultConfig(
+                setting_field="VERIFY_EMAIL_RATE_LIMIT_EMAIL", default_value=None
+            ),
+            "rate_limit_ip_header": DefaultConfig(
+                setting_field="VERIFY_EMAIL_RATE_LIMIT_IP_HEADER", default_value=None
+            ),
+            "rate_limit_cache": DefaultConfig(
+                setting_field="VERIFY_EMAIL_RATE_LIMIT_CACHE", default_value="default"
+            ),
+            "link_format": DefaultConfig(
+                setting_field="VERIFY_EMAIL_LINK_FORMAT", default_value="email"
+            ),
+            "signing_keys": DefaultConfig(
+                setting_field="VERIFY_EMAIL_SIGNING_KEYS", default_value=None
+            ),
+            "link_cache": DefaultConfig(
+                setting_field="VERIFY_EMAIL_LINK_CACHE", default_value="default"
+            ),
+            "negative_cache_ttl": DefaultConfig(
+                setting_field="VERIFY_EMAIL_NEGATIVE_CACHE_TTL", default_value="5m"
+            ),
+            "consumed_link_ttl": DefaultConfig(
+                setting_field="VERIFY_EMAIL_CONSUMED_LINK_TTL", default_value="1d"
+            ),
+            "metrics_backend": DefaultConfig(
+                setting_field="VERIFY_EMAIL_METRICS_BACKEND",
+                default_value="verify_email.metrics.MetricsBackend",
+            ),
+            "metrics_view": DefaultConfig(
+                setting_field="VERIFY_EMAIL_METRICS_VIEW", default_value=False
+            ),
+            "async_views": DefaultConfig(
+                setting_field="VERIFY_EMAIL_ASYNC_VIEWS", default_value=False
+            ),
+            "async_email_sender": DefaultConfig(
+                setting_field="VERIFY_EMAIL_ASYNC_EMAIL_SENDER", default_value=None
+            ),
         }
 
     def get(self, field_name, raise_exception=True, default_type=str):
@@ -92,3 +177,220 @@ class GetFieldFromSettings:
                 return None
             raise AttributeError
         return attr
+
+
+def get_seconds(interval: Union[int, str]) -> Union[int, float]:
+    """
+    Converts a time interval like "EXPIRE_AFTER" into seconds.
+
+    An integer is considered in seconds, a string can be suffixed with a unit from TIME_UNITS
+    (seconds if no unit is given), e.g. 10, "15s", "5m", "1h", "2d".
+
+    Raises
+    ------
+    WrongTimeInterval
+        If the time is not greater than 0 or the unit is not supported.
+    """
+    if isinstance(interval, int):
+        return interval
+    if not isinstance(interval, str):
+        raise WrongTimeInterval(f"Time unit must be from : {TIME_UNITS}")
+
+    unit = interval[-1:] if interval[-1:] in TIME_UNITS else "s"
+    digits = interval[:-1] if interval[-1:] in TIME_UNITS else interval
+    try:
+        digit_time = int(digits)
+    except ValueError:
+        raise WrongTimeInterval(f"Time unit must be from : {TIME_UNITS}")
+    if digit_time <= 0:
+        raise WrongTimeInterval("Time must be greater than 0")
+
+    if unit == "s":
+        return digit_time
+    if unit == "m":
+        return timedelta(minutes=digit_time).total_seconds()
+    if unit == "h":
+        return timedelta(hours=digit_time).total_seconds()
+    return timedelta(days=digit_time).total_seconds()
+
+
+def parse_rate(rate: str) -> Tuple[int, Union[int, float]]:
+    """
+    Converts a rate like "VERIFY_EMAIL_RATE_LIMIT_IP" into (number of requests, period in seconds),
+    e.g. "5/m" -> (5, 60.0), "100/12h" -> (100, 43200.0).
+
+    Raises
+    ------
+    WrongTimeInterval
+        If the rate is not "<count>/<interval>" or the interval is not valid.
+    """
+    count, _, period = str(rate).partition("/")
+    try:
+        count = int(count)
+    except ValueError:
+        count = 0
+    if count <= 0 or not period:
+        raise WrongTimeInterval(f'Rate must look like "5/m" or "100/12h", got {rate!r}')
+    if period in TIME_UNITS:
+        period = f"1{period}"
+    return count, get_seconds(period)
+
+
+def parse_signing_keys(keys) -> Tuple[Tuple[str, str], ...]:
+    """
+    Converts "VERIFY_EMAIL_SIGNING_KEYS", a dict of key id to secret whose first entry signs
+    the new tokens, into a tuple of (key id, secret) pairs.
+
+    Raises
+    ------
+    ImproperlyConfigured
+        If a key id is empty or longer than 255 bytes, or a secret is empty.
+    """
+    if not keys:
+        return ()
+    pairs = tuple((str(key_id), secret) for key_id, secret in dict(keys).items())
+    for key_id, secret in pairs:
+        if not 0 < len(key_id.encode()) <= 255 or not secret:
+            raise ImproperlyConfigured(
+                f"VERIFY_EMAIL_SIGNING_KEYS: key id {key_id!r} must be 1 to 255 bytes long"
+                " and its secret must not be empty"
+            )
+    return pairs
+
+
+@dataclass(frozen=True)
+class VerifyEmailSettings:
+    """
+    A frozen snapshot of every setting used by the app.
+
+    It is built once (see "get_settings") and shared by every class of the package, instead of
+    each object building its own GetFieldFromSettings and calling getattr(settings, ...) on every
+    lookup. "max_age" already holds "EXPIRE_AFTER" in seconds (or None), so a wrong value like "5x"
+    fails when the snapshot is built at startup instead of on the first verification.
+
+    The snapshot is dropped when one of its settings changes (django's "setting_changed" signal).
+    """
+
+    debug: bool
+    subject: str
+    email_field_name: str
+    html_message_template: str
+    text_message_template: Optional[str]
+    from_alias: str
+    login_page: str
+    verification_success_template: Optional[str]
+    verification_success_msg: str
+    verification_failed_template: str
+    link_expired_template: str
+    verification_failed_msg: str
+    request_new_email_template: str
+    new_email_sent_template: str
+    salt: Optional[str]
+    sep: str
+    key: Optional[str]
+    max_age: Optional[Union[int, float]]
+    max_retries: int
+    dispatch: str
+    dispatch_workers: int
+    dispatch_queue_size: int
+    dispatch_backpressure: str
+    email_pool_backend: str
+    email_pool_size: int
+    email_pool_max_messages: int
+    email_pool_max_age: Union[int, float]
+    case_insensitive_email: bool
+    cache_pages: bool
+    rate_limit_ip: Optional[Tuple[int, Union[int, float]]]
+    rate_limit_email: Optional[Tuple[int, Union[int, float]]]
+    rate_limit_ip_header: Optional[str]
+    rate_limit_cache: str
+    link_format: str
+    signing_keys: Tuple[Tuple[str, str], ...]
+    link_cache: str
+    negative_cache_ttl: Optional[Union[int, float]]
+    consumed_link_ttl: Optional[Union[int, float]]
+    metrics_backend: str
+    metrics_view: bool
+    async_views: bool
+    async_email_sender: Optional[str]
+
+    @classmethod
+    def from_settings(cls) -> "VerifyEmailSettings":
+        getter = GetFieldFromSettings()
+        values = {
+            item.name: getter.get(item.name, raise_exception=False)
+            for item in fields(cls)
+        }
+        if values["max_age"]:
+            values["max_age"] = get_seconds(values["max_age"])
+        values["email_pool_max_age"] = get_seconds(values["email_pool_max_age"])
+        for name in ("negative_cache_ttl", "consumed_link_ttl"):
+            if values[name]:
+                values[name] = get_seconds(values[name])
+        for name in ("rate_limit_ip", "rate_limit_email"):
+            if values[name]:
+                values[name] = parse_rate(values[name])
+        values["signing_keys"] = parse_signing_keys(values["signing_keys"])
+        return cls(**values)
+
+    def get(self, field_name: str, raise_exception: bool = True, default_type=str) -> Any:
+        """
+        Same as GetFieldFromSettings.get, kept for code that still looks settings up by name.
+        """
+        return getattr(self, field_name)
+
+
+SETTING_NAMES = frozenset(
+    config.setting_field for config in GetFieldFromSettings().defaults_configs.values()
+)
+
+_snapshot: Optional[VerifyEmailSettings] = None
+_snapshot_lock = threading.Lock()
+
+
+def get_settings() -> VerifyEmailSettings:
+    """
+    Returns the process wide settings snapshot, building it on first use.
+    """
+    global _snapshot
+    snapshot = _snapshot
+    if snapshot is None:
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = VerifyEmailSettings.from_settings()
+            snapshot = _snapshot
+    return snapshot
+
+
+def clear_settings() -> None:
+    """
+    Drops the settings snapshot, the next "get_settings" call builds a new one.
+    """
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = None
+
+
+_shared_instances: Dict[type, Tuple[VerifyEmailSettings, Any]] = {}
+# reentrant: building an instance builds its own shared members
+_shared_instances_lock = threading.RLock()
+
+
+def get_shared_instance(cls: Type[T]) -> T:
+    """
+    Returns a process wide instance of "cls" built for the current settings snapshot.
+
+    The managers of this package (TokenManager, ActivationMailManager, UserActivationProcess...)
+    hold no per-request state, so a single instance can safely be used by every thread instead of
+    building a new signer, link manager and url encoder for every request. When the settings
+    snapshot changes, the instance is rebuilt on the next call.
+    """
+    settings = get_settings()
+    built_for, instance = _shared_instances.get(cls, (None, None))
+    if built_for is not settings:
+        with _shared_instances_lock:
+            built_for, instance = _shared_instances.get(cls, (None, None))
+            if built_for is not settings:
+                instance = cls()
+                _shared_instances[cls] = (settings, instance)
+    return instance
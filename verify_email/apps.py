@@ -11,3 +11,9 @@ class VerifyEmailConfig(AppConfig):
     def ready(self):
         logger.info("[Email Verification] : importing signals    - OK.")
         import verify_email.signals
+
+        from .app_configurations import get_settings
+
+        # build the settings snapshot now, so that wrong values fail at startup
+        get_settings()
+        logger.info("[Email Verification] : loading settings     - OK.")
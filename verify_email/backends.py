@@ -0,0 +1,203 @@
+import atexit
+import logging
+import smtplib
+import threading
+import time
+from dataclasses import dataclass, field
+
+from django.core.mail import get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+
+from .app_configurations import get_settings
+
+__all__ = ["ConnectionPool", "PooledEmailBackend", "close_pools", "get_pool"]
+
+logger = logging.getLogger(__name__)
+
+# a connection idle for longer is checked with a NOOP before it is reused
+HEALTH_CHECK_AFTER = 5
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+@dataclass
+class PooledConnection:
+    connection: BaseEmailBackend
+    created_at: float = field(default_factory=time.monotonic)
+    used_at: float = field(default_factory=time.monotonic)
+    sent: int = 0
+
+
+class ConnectionPool:
+    """
+    A bounded set of open connections of an email backend, shared by every thread.
+
+    "checkout()" returns an idle connection (the most recently used one first, its TLS session
+    is the warmest) or opens a new one while fewer than "size" are open, otherwise it waits for
+    a connection to be checked in. A connection is closed instead of being reused once it sent
+    "max_messages" messages or is older than "max_age" seconds, after an error, or if it fails
+    a NOOP after being idle for HEALTH_CHECK_AFTER seconds (SMTP connections only).
+    """
+
+    def __init__(
+        self, backend: str, size: int, max_messages: int, max_age: float, **kwargs
+    ):
+        self.backend = backend
+        self.size = size
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.kwargs = kwargs
+        self._idle = []
+        self._open = 0
+        self._closed = False
+        self._condition = threading.Condition()
+
+    def _is_stale(self, pooled: PooledConnection, now: float) -> bool:
+        return (
+            pooled.sent >= self.max_messages or now - pooled.created_at >= self.max_age
+        )
+
+    @staticmethod
+    def _is_healthy(pooled: PooledConnection) -> bool:
+        smtp = getattr(pooled.connection, "connection", None)
+        if smtp is None or not hasattr(smtp, "noop"):
+            return True
+        try:
+            return smtp.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _open_connection(self) -> PooledConnection:
+        connection = get_connection(self.backend, fail_silently=False, **self.kwargs)
+        connection.open()
+        return PooledConnection(connection)
+
+    def _close_connection(self, pooled: PooledConnection) -> None:
+        try:
+            pooled.connection.close()
+        except Exception:
+            logger.warning(
+                "Error occurred while closing a pooled email connection", exc_info=True
+            )
+
+    def _release_slot(self) -> None:
+        with self._condition:
+            self._open -= 1
+            self._condition.notify()
+
+    def checkout(self) -> PooledConnection:
+        while True:
+            with self._condition:
+                while not self._idle and self._open >= self.size:
+                    self._condition.wait()
+                pooled = self._idle.pop() if self._idle else None
+                if pooled is None:
+                    self._open += 1
+            if pooled is None:
+                try:
+                    return self._open_connection()
+                except BaseException:
+                    self._release_slot()
+                    raise
+
+            now = time.monotonic()
+            if not self._is_stale(pooled, now) and (
+                now - pooled.used_at < HEALTH_CHECK_AFTER or self._is_healthy(pooled)
+            ):
+                return pooled
+            self.discard(pooled)
+
+    def checkin(self, pooled: PooledConnection) -> None:
+        pooled.used_at = time.monotonic()
+        if self._closed or self._is_stale(pooled, pooled.used_at):
+            self.discard(pooled)
+            return
+        with self._condition:
+            self._idle.append(pooled)
+            self._condition.notify()
+
+    def discard(self, pooled: PooledConnection) -> None:
+        self._close_connection(pooled)
+        self._release_slot()
+
+    def send_messages(self, email_messages) -> int:
+        pooled = self.checkout()
+        try:
+            sent = pooled.connection.send_messages(email_messages) or 0
+        except BaseException:
+            self.discard(pooled)
+            raise
+        pooled.sent += len(email_messages)
+        self.checkin(pooled)
+        return sent
+
+    def close(self) -> None:
+        """
+        Closes the idle connections, the checked out ones are closed when checked in.
+        """
+        with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for pooled in idle:
+            self.discard(pooled)
+
+
+def get_pool(**kwargs) -> ConnectionPool:
+    """
+    Returns the process wide pool of the backend set by "VERIFY_EMAIL_POOL_BACKEND",
+    one per set of backend arguments (host, port...).
+    """
+    config = get_settings()
+    key = (config.email_pool_backend, tuple(sorted(kwargs.items())))
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(
+                config.email_pool_backend,
+                size=config.email_pool_size,
+                max_messages=config.email_pool_max_messages,
+                max_age=config.email_pool_max_age,
+                **kwargs,
+            )
+        return pool
+
+
+def close_pools() -> None:
+    """
+    Closes every pool, new ones are created from the current settings on the next send.
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+
+atexit.register(close_pools)
+
+
+class PooledEmailBackend(BaseEmailBackend):
+    """
+    Email backend sending through a pool of open connections of another backend:
+
+        EMAIL_BACKEND = "verify_email.backends.PooledEmailBackend"
+        VERIFY_EMAIL_POOL_BACKEND = "django.core.mail.backends.smtp.EmailBackend"
+
+    Django builds a backend for every "send_mail" call, which then opens and closes its own
+    connection, the connections of this backend outlive it and are reused by every thread.
+    """
+
+    def __init__(self, fail_silently=False, **kwargs):
+        super().__init__(fail_silently=fail_silently)
+        self.kwargs = kwargs
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        try:
+            return get_pool(**self.kwargs).send_messages(list(email_messages))
+        except Exception:
+            if not self.fail_silently:
+                raise
+            return 0
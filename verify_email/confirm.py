@@ -1,6 +1,7 @@
 import logging
 from dataclasses import dataclass, field
 
+from .app_configurations import get_shared_instance
 from .token_manager import TokenManager
 from .custom_types import User
 from django.utils import timezone
@@ -35,7 +36,9 @@ class UserActivationProcess:
     - InvalidToken: Raised when the provided token is invalid.
     """
 
-    token_manager: TokenManager = field(default_factory=TokenManager)
+    token_manager: TokenManager = field(
+        default_factory=lambda: get_shared_instance(TokenManager)
+    )
 
     @classmethod
     def activate_user(cls, encoded_email: str, encoded_token: str) -> User:
@@ -69,11 +72,10 @@ class UserActivationProcess:
 
         Notes
         -----
-        This method instantiates the class to access its methods. This
-        approach may be revised in the future as part of the class design
-        considerations.
+        This method uses the process wide instance of the class (see "get_shared_instance"),
+        so the token manager is not rebuilt on every request.
         """
-        self = cls()  # Consider if instantiation is necessary here
+        self = get_shared_instance(cls)
         try:
             # Verify token and retrieve user object
             # this will return inactive user
@@ -84,9 +86,30 @@ class UserActivationProcess:
             # Activate the user account
             user.is_active = True
             user.last_login = timezone.now()
-            user.save()
+            user.save(update_fields=["is_active", "last_login"])
+            self.token_manager.link_manager.clear_pending_verification(user)
             return user
         except Exception as err:
             logger.exception(err)
             # Perform any necessary cleanup if required
             raise
+
+    @classmethod
+    async def aactivate_user(cls, encoded_email: str, encoded_token: str) -> User:
+        """
+        Async version of "activate_user", the user is fetched and saved with the async ORM.
+        """
+        self = get_shared_instance(cls)
+        try:
+            user = await self.token_manager.adecrypt_token_and_get_user(
+                encoded_email, encoded_token
+            )
+
+            user.is_active = True
+            user.last_login = timezone.now()
+            await user.asave(update_fields=["is_active", "last_login"])
+            await self.token_manager.link_manager.aclear_pending_verification(user)
+            return user
+        except Exception as err:
+            logger.exception(err)
+            raise
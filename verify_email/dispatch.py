@@ -0,0 +1,151 @@
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .app_configurations import get_settings
+from .errors import DispatchQueueFull
+
+__all__ = [
+    "BoundedExecutor",
+    "adispatch_message",
+    "dispatch_message",
+    "get_executor",
+    "shutdown_executor",
+]
+
+logger = logging.getLogger(__name__)
+
+DISPATCH_MODES = ("sync", "threadpool", "outbox")
+BACKPRESSURE_POLICIES = ("block", "caller", "raise")
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class BoundedExecutor:
+    """
+    A thread pool that accepts at most "max_workers + queue_size" pending jobs.
+
+    ThreadPoolExecutor has an unbounded work queue, so a burst of signups against a slow
+    mail relay would pile up rendered messages in memory. Every submitted job takes a slot
+    from a semaphore which is given back when the job finishes.
+
+    When all the slots are taken, the "backpressure" policy decides what happens:
+        - "block"  : wait until a slot is free.
+        - "caller" : run the job synchronously in the calling thread.
+        - "raise"  : raise DispatchQueueFull.
+    """
+
+    def __init__(self, max_workers: int, queue_size: int, backpressure: str = "block"):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ImproperlyConfigured(
+                f"VERIFY_EMAIL_DISPATCH_BACKPRESSURE must be one of {BACKPRESSURE_POLICIES}, got {backpressure!r}"
+            )
+        self.backpressure = backpressure
+        self._slots = threading.BoundedSemaphore(max_workers + queue_size)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="verify-email"
+        )
+
+    def _release(self, future):
+        self._slots.release()
+        error = future.exception()
+        if error is not None:
+            logger.error(
+                "Error occurred while sending the verification email in background",
+                exc_info=error,
+            )
+
+    def submit(self, fn, *args, **kwargs):
+        if not self._slots.acquire(blocking=self.backpressure == "block"):
+            if self.backpressure == "caller":
+                return fn(*args, **kwargs)
+            raise DispatchQueueFull("Verification email queue is full")
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+def get_executor() -> BoundedExecutor:
+    """
+    Returns the process wide executor, creating it from settings on first use.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            settings = get_settings()
+            _executor = BoundedExecutor(
+                max_workers=settings.dispatch_workers,
+                queue_size=settings.dispatch_queue_size,
+                backpressure=settings.dispatch_backpressure,
+            )
+        return _executor
+
+
+def shutdown_executor(wait: bool = True) -> None:
+    """
+    Waits for the queued emails to be sent and drops the executor,
+    a new one will be created from the current settings on the next dispatch.
+    """
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=wait)
+
+
+atexit.register(shutdown_executor)
+
+
+def dispatch_message(message):
+    """
+    Sends an email message according to "VERIFY_EMAIL_DISPATCH":
+        - "sync"       : send it right away in the current thread (default).
+        - "threadpool" : hand it to the bounded background executor.
+        - "outbox"     : store it in the outbox table, the "verify_email_drain_outbox"
+                         command sends it later.
+    """
+    mode = get_settings().dispatch
+    if mode == "sync":
+        return message.send()
+    if mode == "threadpool":
+        return get_executor().submit(message.send)
+    if mode == "outbox":
+        from .models import OutboxMessage
+
+        return OutboxMessage.enqueue(message)
+    raise ImproperlyConfigured(
+        f"VERIFY_EMAIL_DISPATCH must be one of {DISPATCH_MODES}, got {mode!r}"
+    )
+
+
+async def adispatch_message(message):
+    """
+    Async version of "dispatch_message".
+
+    If "VERIFY_EMAIL_ASYNC_EMAIL_SENDER" is set, it is the dotted path of a coroutine function
+    taking the message, e.g. a sender built on an async SMTP client. Otherwise the message is
+    dispatched as configured by "VERIFY_EMAIL_DISPATCH", the blocking parts in a worker thread.
+    """
+    settings = get_settings()
+    if settings.async_email_sender:
+        return await import_string(settings.async_email_sender)(message)
+    if settings.dispatch == "threadpool" and settings.dispatch_backpressure == "raise":
+        # never blocks, the message is queued or DispatchQueueFull is raised
+        return dispatch_message(message)
+    if settings.dispatch == "outbox":
+        # uses the database, keep it on the thread the async ORM uses
+        return await sync_to_async(dispatch_message)(message)
+    return await sync_to_async(dispatch_message, thread_sensitive=False)(message)
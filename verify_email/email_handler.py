@@ -1,17 +1,47 @@
 from dataclasses import dataclass, field
+from functools import cached_property, lru_cache
 import logging
 
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
-from django.utils.html import strip_tags
+from django.contrib.auth import get_user_model
+from django.core import signing
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.template.loader import get_template
+from django.utils.html import escape, strip_tags
 
-from .app_configurations import GetFieldFromSettings
-from .errors import InvalidTokenOrEmail
-from .token_manager import TokenManager
+from .app_configurations import VerifyEmailSettings, get_settings, get_shared_instance
+from .dispatch import adispatch_message, dispatch_message
+from .errors import DecodingFailed, InvalidTokenOrEmail
+from .metrics import get_metrics
+from .compact import COMPACT_LINK_MARKER
+from .token_manager import LinkTarget, TokenManager, decode_link_target
 from .custom_types import User
 
 logger = logging.getLogger(__name__)
 
+# stands for the link in the html used as key of the plain-text cache, unchanged by escape() and strip_tags()
+LINK_PLACEHOLDER = "VERIFYEMAILLINKPLACEHOLDER"
+
+
+@lru_cache(maxsize=32)
+def _cached_strip_tags(html: str) -> str:
+    return strip_tags(html)
+
+
+def html_to_text(html: str, link: str) -> str:
+    """
+    Returns strip_tags(html) reusing the previous result for the same template output.
+
+    strip_tags runs the html parser, which is slow on styled templates. The link is the only
+    part of the message that changes from one user to another, so it is replaced by a placeholder
+    before looking up the cache and put back in the stripped text. Templates whose output also
+    depends on the user simply miss the cache.
+    """
+    escaped_link = escape(link)
+    if not link or LINK_PLACEHOLDER in html or escaped_link not in html:
+        return strip_tags(html)
+    text = _cached_strip_tags(html.replace(escaped_link, LINK_PLACEHOLDER))
+    return text.replace(LINK_PLACEHOLDER, escaped_link)
+
 
 @dataclass(frozen=True)
 class ActivationMailManager:
@@ -21,37 +51,81 @@ class ActivationMailManager:
     2. sends the email to user with that link.
     """
 
-    token_manager: TokenManager = field(default_factory=TokenManager)
-    settings: GetFieldFromSettings = field(default_factory=GetFieldFromSettings)
+    token_manager: TokenManager = field(
+        default_factory=lambda: get_shared_instance(TokenManager)
+    )
+    settings: VerifyEmailSettings = field(default_factory=get_settings)
 
     def _generate_verification_url(
         self, inactive_user: User, user_email: str, request=None
     ):
         token = self.token_manager.generate_token_for_user(inactive_user)
         link = (
-            self.token_manager.link_manager.generate_link(token, user_email)
+            self.token_manager.link_manager.generate_link(
+                token, user_email, inactive_user
+            )
             if not request
             else self.token_manager.link_manager.get_absolute_verification_url(
-                request, token, user_email
+                request, token, user_email, inactive_user
             )
         )
         return link
 
     # Private :
-    def _send_email(self, msg, useremail):
-        subject = self.settings.get("subject")
-        send_mail(
-            subject,
-            strip_tags(msg),
-            from_email=self.settings.get("from_alias"),
-            recipient_list=[useremail],
-            html_message=msg,
+    def _load_templates(self):
+        text_template = self.settings.text_message_template
+        return (
+            get_template(self.settings.html_message_template),
+            get_template(text_template) if text_template else None,
         )
 
+    @cached_property
+    def _templates(self):
+        # loaded and compiled once per settings snapshot, see get_shared_instance()
+        return self._load_templates()
+
+    def _render_message(self, link, request=None, inactive_user=None):
+        """
+        Returns the html and plain-text bodies of the verification email.
+        """
+        context = {"link": link}
+        if inactive_user is not None:
+            context["inactive_user"] = inactive_user
+        # in debug mode, pick up template edits while developing
+        html_template, text_template = (
+            self._load_templates() if self.settings.debug else self._templates
+        )
+        with get_metrics().timer("template_render"):
+            msg = html_template.render(context, request)
+            if text_template is not None:
+                return msg, text_template.render(context, request)
+            return msg, html_to_text(msg, link)
+
+    def _build_message(self, msg, useremail, connection=None):
+        html, text = msg
+        message = EmailMultiAlternatives(
+            self.settings.subject,
+            text,
+            from_email=self.settings.from_alias,
+            to=[useremail],
+            connection=connection,
+        )
+        message.attach_alternative(html, "text/html")
+        return message
+
+    def _send_email(self, msg, useremail):
+        # with the threadpool or outbox dispatch, this only times the hand-off
+        with get_metrics().timer("email_send"):
+            dispatch_message(self._build_message(msg, useremail))
+
+    async def _asend_email(self, msg, useremail):
+        with get_metrics().timer("email_send"):
+            await adispatch_message(self._build_message(msg, useremail))
+
     # Public :
     @classmethod
     def send_verification_link(cls, inactive_user=None, form=None, request=None):
-        self = cls()
+        self = get_shared_instance(cls)
 
         if form:
             inactive_user = form.save(commit=False)
@@ -62,7 +136,7 @@ class ActivationMailManager:
         try:
 
             useremail = (
-                form.cleaned_data.get(self.settings.get("email_field_name"))
+                form.cleaned_data.get(self.settings.email_field_name)
                 if form
                 else inactive_user.email
             )
@@ -76,10 +150,11 @@ class ActivationMailManager:
             verification_url = self._generate_verification_url(
                 inactive_user, useremail, request=request
             )
-            msg = render_to_string(
-                self.settings.get("html_message_template", raise_exception=True),
-                {"link": verification_url, "inactive_user": inactive_user},
-                request=request,
+            self.token_manager.link_manager.register_pending_verification(
+                inactive_user, useremail
+            )
+            msg = self._render_message(
+                verification_url, request=request, inactive_user=inactive_user
             )
 
             self._send_email(msg, useremail)
@@ -88,6 +163,69 @@ class ActivationMailManager:
             inactive_user.delete()
             raise
 
+    @classmethod
+    def send_verification_links(cls, inactive_users, request=None, batch_size=500):
+        """
+        Sends verification links to many users at once.
+
+        All the users are marked inactive with a single bulk_update per batch and every email
+        is sent over one mail connection, instead of one SMTP session and one save() per user.
+        Users without an email address are skipped.
+
+        Parameters
+        ----------
+        inactive_users : QuerySet or iterable of User
+            The users who should receive a verification link.
+        request : HttpRequest, optional
+            Used to build absolute verification urls and passed to the message template.
+        batch_size : int
+            Number of users updated and sent per batch.
+
+        Returns
+        -------
+        int
+            The number of emails sent.
+        """
+        self = get_shared_instance(cls)
+        sent = 0
+        batch = []
+
+        connection = get_connection()
+        connection.open()
+        try:
+            for inactive_user in inactive_users:
+                if not inactive_user.email:
+                    continue
+                batch.append(inactive_user)
+                if len(batch) >= batch_size:
+                    sent += self._send_batch(batch, connection, request)
+                    batch = []
+            if batch:
+                sent += self._send_batch(batch, connection, request)
+        finally:
+            connection.close()
+        return sent
+
+    def _send_batch(self, inactive_users, connection, request=None):
+        for inactive_user in inactive_users:
+            inactive_user.is_active = False
+        get_user_model().objects.bulk_update(inactive_users, ["is_active"])
+        self.token_manager.link_manager.register_pending_verifications(inactive_users)
+
+        messages = []
+        base_url = request.build_absolute_uri("/") if request else None
+        for inactive_user, _, verification_url in (
+            self.token_manager.generate_tokens_for_users(inactive_users, base_url)
+        ):
+            msg = self._render_message(
+                verification_url, request=request, inactive_user=inactive_user
+            )
+            messages.append(
+                self._build_message(msg, inactive_user.email, connection=connection)
+            )
+        with get_metrics().timer("email_send"):
+            return connection.send_messages(messages) or 0
+
     @classmethod
     def resend_verification_link(cls, request, email, **kwargs):
         """
@@ -100,41 +238,21 @@ class ActivationMailManager:
 
         These exception should be handled in caller function.
         """
-        self = cls()
+        self = get_shared_instance(cls)
 
         try:
-            inactive_user = kwargs.get("user")
-            user_encoded_token = kwargs.get("token")
-            encoded = kwargs.get("encoded", True)
-
-            if not inactive_user or not email:
-                raise InvalidTokenOrEmail(
-                    f"Either token or email is invalid. user: {inactive_user}, email: {email}"
-                )
-
-            if encoded:
-                decoded_enc_user_token = (
-                    self.token_manager.safe_url_encoder.perform_decoding(
-                        user_encoded_token
-                    )
-                )
-                decoded_email = self.token_manager.safe_url_encoder.perform_decoding(
-                    email
-                )
-                inactive_user = self.token_manager.get_user_by_token(
-                    decoded_email, decoded_enc_user_token
-                )
+            inactive_user, email, user_token = self._parse_resend_arguments(
+                email, **kwargs
+            )
+            if user_token is not None:
+                inactive_user, email = self._get_user_from_link(email, user_token)
 
             # At this point, we have decoded email(if it was encoded), and inactive_user, and we can request new link
             new_token = self.token_manager.generate_token_for_user(inactive_user)
             link = self.token_manager.link_manager.request_new_link(
                 request, inactive_user, new_token, email
             )
-            msg = render_to_string(
-                self.settings.get("html_message_template", raise_exception=True),
-                {"link": link},
-                request=request,
-            )
+            msg = self._render_message(link, request=request)
             self._send_email(msg, email)
             return True
         except Exception as err:
@@ -142,3 +260,80 @@ class ActivationMailManager:
                 f"Error occurred during re sending the email with verification link: {err}"
             )
             raise err
+
+    @classmethod
+    async def aresend_verification_link(cls, request, email, **kwargs):
+        """
+        Async version of "resend_verification_link", the database is accessed with the async ORM
+        and the email is sent through "adispatch_message".
+        """
+        self = get_shared_instance(cls)
+
+        try:
+            inactive_user, email, user_token = self._parse_resend_arguments(
+                email, **kwargs
+            )
+            if user_token is not None:
+                inactive_user, email = await self._aget_user_from_link(
+                    email, user_token
+                )
+
+            new_token = self.token_manager.generate_token_for_user(inactive_user)
+            link = await self.token_manager.link_manager.arequest_new_link(
+                request, inactive_user, new_token, email
+            )
+            msg = self._render_message(link, request=request)
+            await self._asend_email(msg, email)
+            return True
+        except Exception as err:
+            logger.error(
+                f"Error occurred during re sending the email with verification link: {err}"
+            )
+            raise err
+
+    def _parse_resend_arguments(self, email, user=None, token=None, encoded=True):
+        """
+        Returns (inactive user, plain email, decoded token).
+
+        When "encoded" is True, email and token come from a previously sent link: both are decoded
+        and the user has to be looked up by token (the returned user is None, and the email is
+        the LinkTarget of the link, see "_get_user_from_link").
+        Otherwise the decoded token is None and the given user is used.
+        """
+        if not email or not (user or token):
+            raise InvalidTokenOrEmail(
+                f"Either token or email is invalid. user: {user}, email: {email}"
+            )
+        if not encoded:
+            return user, email, None
+        if email == COMPACT_LINK_MARKER:
+            try:
+                compact_token = self.token_manager.compact_signer.parse(token)
+            except (DecodingFailed, signing.BadSignature):
+                raise InvalidTokenOrEmail(f"The compact token is invalid. token: {token}")
+            return None, LinkTarget(pk=compact_token.pk), compact_token
+
+        decoded_token = self.token_manager.safe_url_encoder.perform_decoding(token)
+        target = decode_link_target(email)
+        if not decoded_token or not target:
+            raise InvalidTokenOrEmail(
+                f"Either token or email is invalid. token: {token}, email: {email}"
+            )
+        return None, target, decoded_token
+
+    def _get_user_from_link(self, target, user_token):
+        """
+        Returns (inactive user, email) of a previously sent link.
+        """
+        if target.pk is None:
+            user = self.token_manager.get_user_by_token(target.email, user_token)
+            return user, target.email
+        user = self.token_manager.get_user_by_pk_and_token(target.pk, user_token)
+        return user, getattr(user, user.get_email_field_name())
+
+    async def _aget_user_from_link(self, target, user_token):
+        if target.pk is None:
+            user = await self.token_manager.aget_user_by_token(target.email, user_token)
+            return user, target.email
+        user = await self.token_manager.aget_user_by_pk_and_token(target.pk, user_token)
+        return user, getattr(user, user.get_email_field_name())
@@ -31,3 +31,14 @@ class WrongTimeInterval(Exception):
 class DecodingFailed(Exception):
     def __init__(self, *args: object) -> None:
         super().__init__(*args)
+
+
+class DispatchQueueFull(Exception):
+    def __init__(self, *args: object) -> None:
+        super().__init__(*args)
+
+
+class RateLimited(Exception):
+    def __init__(self, *args: object, retry_after: float = 0) -> None:
+        super().__init__(*args)
+        self.retry_after = retry_after
@@ -0,0 +1,135 @@
+import hashlib
+
+from django.core import signing
+from django.core.cache import caches
+
+from .app_configurations import get_settings
+from .errors import DecodingFailed, InvalidToken
+from .metrics import get_metrics
+
+__all__ = [
+    "aget_link_state",
+    "amark_link_consumed",
+    "aremember_bad_link",
+    "get_link_digest",
+    "get_link_state",
+    "mark_link_consumed",
+    "remember_bad_link",
+]
+
+# errors which will be raised again for the same link, whatever happens to the user
+BAD_LINK_ERRORS = {
+    "bad_signature": signing.BadSignature,
+    "decoding_failed": DecodingFailed,
+    "invalid_token": InvalidToken,
+    "invalid_value": ValueError,
+}
+
+
+def get_link_digest(user_email: str, user_token: str) -> str:
+    return hashlib.sha256(f"{user_email}\0{user_token}".encode()).hexdigest()
+
+
+def _key(kind, digest):
+    return f"verify_email:{kind}:{digest}"
+
+
+def _get_bad_link_reason(error):
+    if isinstance(error, signing.SignatureExpired):
+        # the user can still request a new link from it
+        return None
+    for reason, error_class in BAD_LINK_ERRORS.items():
+        if isinstance(error, error_class):
+            return reason
+    # TypeError, UserNotFound...
+    return None
+
+
+def _known_bad_link(reason):
+    get_metrics().increment("negative_cache", result="miss" if reason is None else "hit")
+    if reason is None:
+        return None
+    return BAD_LINK_ERRORS[reason]("This link was already found bad")
+
+
+def _get_state_keys(config, digest):
+    keys = []
+    if config.consumed_link_ttl:
+        keys.append(_key("consumed", digest))
+    if config.negative_cache_ttl:
+        keys.append(_key("bad-link", digest))
+    return keys
+
+
+def _get_link_state(config, digest, values):
+    if values.get(_key("consumed", digest)):
+        return True, None
+    if not config.negative_cache_ttl:
+        return False, None
+    return False, _known_bad_link(values.get(_key("bad-link", digest)))
+
+
+def get_link_state(digest: str):
+    """
+    Returns (consumed, error) for the link of this digest, with a single cache lookup.
+
+    "consumed" is True if the link was already used to activate its user (webmail previews,
+    second clicks...), see "mark_link_consumed". "error" is the error to raise if the link was
+    recently found bad, see "remember_bad_link", otherwise None.
+
+    Both are answered without decoding, unsigning or querying the user table.
+    """
+    config = get_settings()
+    keys = _get_state_keys(config, digest)
+    if not keys:
+        return False, None
+    return _get_link_state(config, digest, caches[config.link_cache].get_many(keys))
+
+
+def mark_link_consumed(digest: str) -> None:
+    """
+    Records that the link of this digest activated its user, for "VERIFY_EMAIL_CONSUMED_LINK_TTL".
+    """
+    config = get_settings()
+    if config.consumed_link_ttl:
+        caches[config.link_cache].set(
+            _key("consumed", digest), True, timeout=config.consumed_link_ttl
+        )
+
+
+def remember_bad_link(digest: str, error: Exception) -> None:
+    """
+    Stores the link of this digest in the negative cache, if "error" will happen again for it.
+    """
+    config = get_settings()
+    reason = _get_bad_link_reason(error)
+    if config.negative_cache_ttl and reason is not None:
+        caches[config.link_cache].set(
+            _key("bad-link", digest), reason, timeout=config.negative_cache_ttl
+        )
+
+
+async def aget_link_state(digest: str):
+    config = get_settings()
+    keys = _get_state_keys(config, digest)
+    if not keys:
+        return False, None
+    values = await caches[config.link_cache].aget_many(keys)
+    return _get_link_state(config, digest, values)
+
+
+async def amark_link_consumed(digest: str) -> None:
+    config = get_settings()
+    if config.consumed_link_ttl:
+        await caches[config.link_cache].aset(
+            _key("consumed", digest), True, timeout=config.consumed_link_ttl
+        )
+
+
+async def aremember_bad_link(digest: str, error: Exception) -> None:
+    config = get_settings()
+    reason = _get_bad_link_reason(error)
+    if config.negative_cache_ttl and reason is not None:
+        await caches[config.link_cache].aset(
+            _key("bad-link", digest), reason, timeout=config.negative_cache_ttl
+        )
@@ -0,0 +1,146 @@
+import time
+from datetime import timedelta
+
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from verify_email.models import OutboxMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends the verification emails stored in the outbox (VERIFY_EMAIL_DISPATCH = 'outbox'). "
+        "Rows are claimed in batches with SELECT ... FOR UPDATE SKIP LOCKED and leased for "
+        "--lease seconds, so several drain processes can run against the same table."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Number of messages claimed and sent over one connection.",
+        )
+        parser.add_argument(
+            "--max-attempts",
+            type=int,
+            default=5,
+            help="Attempts after which a message is marked as failed.",
+        )
+        parser.add_argument(
+            "--backoff",
+            type=float,
+            default=30,
+            help="Base delay in seconds before a retry, doubled after every failed attempt.",
+        )
+        parser.add_argument(
+            "--lease",
+            type=float,
+            default=300,
+            help="Seconds a claimed batch is reserved for this process, after which the messages "
+            "that were not sent are picked up again.",
+        )
+        parser.add_argument(
+            "--loop",
+            action="store_true",
+            help="Keep polling the outbox instead of exiting once it is empty.",
+        )
+        parser.add_argument(
+            "--sleep",
+            type=float,
+            default=5,
+            help="Seconds to wait between polls when the outbox is empty (with --loop).",
+        )
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            drained = self.drain_batch(
+                options["batch_size"],
+                options["max_attempts"],
+                options["backoff"],
+                options["lease"],
+            )
+            total += drained
+            if drained:
+                continue
+            if not options["loop"]:
+                break
+            time.sleep(options["sleep"])
+        self.stdout.write(f"Processed {total} outbox message(s).")
+
+    def drain_batch(self, batch_size, max_attempts, backoff, lease=300):
+        """
+        Claims one batch of due messages and sends it over a single connection.
+
+        The batch is claimed in a short transaction which moves the "next_attempt_at" of its rows
+        "lease" seconds ahead, so other drain processes skip them. No lock is held while talking
+        to the mail server: the outcome of every message is saved right after it is sent, if the
+        process dies mid-batch only the messages not sent yet are picked up again, once the lease
+        expires.
+        """
+        now = timezone.now()
+        claimed_until = now + timedelta(seconds=lease)
+        with transaction.atomic():
+            messages = list(
+                OutboxMessage.objects.select_for_update(skip_locked=True)
+                .filter(status=OutboxMessage.PENDING, next_attempt_at__lte=now)
+                .order_by("next_attempt_at")[:batch_size]
+            )
+            if not messages:
+                return 0
+            OutboxMessage.objects.filter(
+                pk__in=[message.pk for message in messages]
+            ).update(next_attempt_at=claimed_until)
+        for message in messages:
+            message.next_attempt_at = claimed_until
+
+        connection = get_connection()
+        try:
+            connection.open()
+        except Exception as err:
+            for message in messages:
+                self._record_failure(message, err, now, max_attempts, backoff)
+                self._save_outcome(message, claimed_until)
+            return len(messages)
+
+        try:
+            for message in messages:
+                try:
+                    connection.send_messages([message.to_message(connection)])
+                except Exception as err:
+                    self._record_failure(message, err, now, max_attempts, backoff)
+                else:
+                    message.status = OutboxMessage.SENT
+                    message.sent_at = timezone.now()
+                    message.last_error = ""
+                self._save_outcome(message, claimed_until)
+        finally:
+            connection.close()
+        return len(messages)
+
+    @staticmethod
+    def _save_outcome(message, claimed_until):
+        # a single UPDATE, skipped if the lease expired and another process claimed the message
+        OutboxMessage.objects.filter(
+            pk=message.pk, next_attempt_at=claimed_until
+        ).update(
+            status=message.status,
+            attempts=message.attempts,
+            next_attempt_at=message.next_attempt_at,
+            last_error=message.last_error,
+            sent_at=message.sent_at,
+        )
+
+    @staticmethod
+    def _record_failure(message, error, now, max_attempts, backoff):
+        message.attempts += 1
+        message.last_error = str(error)
+        if message.attempts >= max_attempts:
+            message.status = OutboxMessage.FAILED
+        else:
+            message.next_attempt_at = now + timedelta(
+                seconds=backoff * 2 ** (message.attempts - 1)
+            )
@@ -0,0 +1,34 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from verify_email.models import (
+    LOWER_EMAIL_INDEX_NAME,
+    add_lower_email_index,
+    remove_lower_email_index,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates (or drops with --drop) the LOWER(email) index on the user table used when "
+        "VERIFY_EMAIL_CASE_INSENSITIVE_EMAIL is enabled after the app's migrations were applied."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--drop", action="store_true", help="Drop the index instead of creating it."
+        )
+
+    def handle(self, *args, **options):
+        user_model = get_user_model()
+        with connection.schema_editor() as schema_editor:
+            if options["drop"]:
+                changed = remove_lower_email_index(schema_editor, user_model)
+            else:
+                changed = add_lower_email_index(schema_editor, user_model)
+        action = "dropped" if options["drop"] else "created"
+        if changed:
+            self.stdout.write(f"Index {LOWER_EMAIL_INDEX_NAME} {action}.")
+        else:
+            self.stdout.write(f"Index {LOWER_EMAIL_INDEX_NAME} not {action}, nothing to do.")
@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import smtplib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.mail import get_connection
+from django.core.management.base import BaseCommand, CommandError
+
+from verify_email.app_configurations import get_shared_instance
+from verify_email.email_handler import ActivationMailManager
+from verify_email.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends a new verification link to every inactive user who never verified their email "
+        "and has retries left (MAX_RETRIES). Users are walked by primary key in pages, the "
+        "emails of a page are rendered and sent by worker threads, each over its own mail "
+        "connection, and the last finished page is written to a checkpoint file so that an "
+        "interrupted run resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--base-url",
+            required=True,
+            help='Prepended to the verification links, e.g. "https://example.com".',
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Number of users read and sent per page.",
+        )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=4,
+            help="Number of threads rendering and sending the emails.",
+        )
+        parser.add_argument(
+            "--checkpoint",
+            help="JSON file storing the progress, read on start and removed once the run completes.",
+        )
+
+    def handle(self, *args, **options):
+        if options["batch_size"] <= 0:
+            raise CommandError("--batch-size must be greater than 0")
+        if options["workers"] <= 0:
+            raise CommandError("--workers must be greater than 0")
+
+        checkpoint = options["checkpoint"]
+        progress = self.read_checkpoint(checkpoint)
+        if progress["last_pk"] is not None:
+            self.stdout.write(f"Resuming after user {progress['last_pk']}.")
+
+        mail_manager = get_shared_instance(ActivationMailManager)
+        sender = ConnectionPerThreadSender(mail_manager)
+        try:
+            with ThreadPoolExecutor(
+                max_workers=options["workers"],
+                thread_name_prefix="verify_email_resend",
+            ) as executor:
+                for users in self.iter_pages(
+                    progress["last_pk"], options["batch_size"]
+                ):
+                    progress["sent"] += self.send_page(
+                        mail_manager, executor, sender, users, options
+                    )
+                    progress["last_pk"] = users[-1].pk
+                    self.write_checkpoint(checkpoint, progress)
+        finally:
+            sender.close()
+
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(f"Sent {progress['sent']} verification link(s).")
+
+    @staticmethod
+    def iter_pages(last_pk, batch_size):
+        """
+        Yields lists of inactive users who never logged in, ordered by pk.
+
+        Each page starts after the last pk of the previous one instead of using an offset, so
+        every query is a bounded range scan and a run can resume from a stored pk.
+        """
+        candidates = (
+            get_user_model()
+            ._default_manager.filter(is_active=False, last_login__isnull=True)
+            .order_by("pk")
+        )
+        while True:
+            page = candidates if last_pk is None else candidates.filter(pk__gt=last_pk)
+            users = list(page[:batch_size].iterator(chunk_size=batch_size))
+            if not users:
+                return
+            last_pk = users[-1].pk
+            yield users
+
+    def send_page(self, mail_manager, executor, sender, users, options):
+        """
+        Takes a retry of every user of the page who has one left, sends their emails spread
+        across the workers, then gives the retry back to the users whose email failed.
+
+        The retry is taken with the same conditional UPDATE as a resend request before the
+        email goes out, so a concurrent request can't go past MAX_RETRIES and a run killed in
+        the middle of a page never sent an email it didn't count. The counters are only
+        updated in this thread, the workers don't touch the database.
+        """
+        link_manager = mail_manager.token_manager.link_manager
+        reserved = [
+            user
+            for user in users
+            if user.email and link_manager._increment_sent_counter(user)
+        ]
+        links = list(
+            mail_manager.token_manager.generate_tokens_for_users(
+                reserved, options["base_url"]
+            )
+        )
+        chunk_size = -(-len(links) // options["workers"]) or 1
+        chunks = [links[i : i + chunk_size] for i in range(0, len(links), chunk_size)]
+        sent_users = [
+            user for sent in executor.map(sender.send, chunks) for user in sent
+        ]
+        if len(sent_users) < len(links):
+            sent_pks = {user.pk for user in sent_users}
+            link_manager._decrement_sent_counters(
+                [user for user in reserved if user.pk not in sent_pks]
+            )
+            self.stderr.write(
+                f"Failed to send {len(links) - len(sent_users)} email(s) of the page ending"
+                f" with user {users[-1].pk}."
+            )
+        return len(sent_users)
+
+    @staticmethod
+    def read_checkpoint(path):
+        if not path or not os.path.exists(path):
+            return {"last_pk": None, "sent": 0}
+        try:
+            with open(path) as file:
+                progress = json.load(file)
+            return {"last_pk": progress["last_pk"], "sent": int(progress["sent"])}
+        except (ValueError, KeyError, TypeError) as err:
+            raise CommandError(f"Invalid checkpoint file {path}: {err}")
+
+    @staticmethod
+    def write_checkpoint(path, progress):
+        if not path:
+            return
+        # written aside then renamed, so a killed run never leaves a truncated file
+        temporary = f"{path}.tmp"
+        with open(temporary, "w") as file:
+            json.dump(
+                {"last_pk": str(progress["last_pk"]), "sent": progress["sent"]}, file
+            )
+        os.replace(temporary, path)
+
+
+class ConnectionPerThreadSender:
+    """
+    Renders and sends lists of (user, token, link), every thread over its own mail connection,
+    opened on first use and kept until "close()".
+    """
+
+    def __init__(self, mail_manager):
+        self.mail_manager = mail_manager
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _get_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = get_connection()
+            connection.open()
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def _drop_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            return
+        self._local.connection = None
+        with self._lock:
+            self._connections.remove(connection)
+        try:
+            connection.close()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+    def _send_message(self, message) -> bool:
+        """
+        Sends a message, once more over a new connection if the current one fails.
+        """
+        for attempt in range(2):
+            try:
+                with get_metrics().timer("email_send"):
+                    return bool(self._get_connection().send_messages([message]))
+            except (smtplib.SMTPException, OSError):
+                logger.warning(
+                    f"Error occurred while sending the verification email to {message.to}",
+                    exc_info=True,
+                )
+                self._drop_connection()
+        return False
+
+    def send(self, links) -> list:
+        """
+        Returns the users whose email was accepted by the mail server.
+        """
+        sent = []
+        for user, _, link in links:
+            message = self.mail_manager._build_message(
+                self.mail_manager._render_message(link, inactive_user=user), user.email
+            )
+            if self._send_message(message):
+                sent.append(user)
+        return sent
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,169 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+from django.utils.module_loading import import_string
+
+from .app_configurations import get_settings
+
+__all__ = ["InMemoryMetrics", "MetricsBackend", "TimingMetricsBackend", "get_metrics"]
+
+# upper bounds in seconds of the histogram buckets kept by InMemoryMetrics
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+)
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+class MetricsBackend:
+    """
+    Receives the timings and counters recorded by the app, the default backend drops them.
+
+    Stages timed with "timer()" :
+        token_generate, token_decode, signer_unsign, db_lookup, template_render, email_send
+
+    Counters incremented with "increment()" :
+        verification (outcome: success, already_verified, expired, bad_signature, max_retries,
+                      invalid, not_found, failed)
+        resend       (outcome: sent, rate_limited, max_retries, invalid, not_found, already_active,
+                      failed)
+        negative_cache (result: hit, miss)
+
+    Subclass it and set "VERIFY_EMAIL_METRICS_BACKEND" to its dotted path to forward them
+    to statsd, prometheus_client...
+    """
+
+    def increment(self, name: str, value: int = 1, **labels) -> None:
+        pass
+
+    def observe(self, stage: str, seconds: float) -> None:
+        pass
+
+    def timer(self, stage: str):
+        """
+        Context manager recording how long its block took with "observe()".
+        """
+        return nullcontext()
+
+
+class TimingMetricsBackend(MetricsBackend):
+    """
+    Base class of the backends that actually record the timings.
+    """
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+
+class InMemoryMetrics(TimingMetricsBackend):
+    """
+    Keeps the counters and a histogram of the timings of every stage in process memory,
+    "render_prometheus()" returns them in the Prometheus text exposition format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (name, sorted label items) -> value
+            self.counters = {}
+            # stage -> [count per bucket (+Inf last), sum, count]
+            self.timings = {}
+
+    def increment(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            timing = self.timings.get(stage)
+            if timing is None:
+                timing = self.timings[stage] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            timing[0][bisect_left(self.buckets, seconds)] += 1
+            timing[1] += seconds
+            timing[2] += 1
+
+    def render_prometheus(self, prefix="verify_email") -> str:
+        with self._lock:
+            counters = sorted(self.counters.items())
+            timings = sorted(
+                (stage, (list(buckets), total, count))
+                for stage, (buckets, total, count) in self.timings.items()
+            )
+
+        lines = []
+        declared = set()
+        for (name, labels), value in counters:
+            metric = f"{prefix}_{name}_total"
+            if metric not in declared:
+                declared.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{_format_labels(labels)} {value}")
+
+        if timings:
+            metric = f"{prefix}_stage_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+        for stage, (buckets, total, count) in timings:
+            cumulative = 0
+            for bound, observed in zip(self.buckets + ("+Inf",), buckets):
+                cumulative += observed
+                labels = _format_labels((("stage", stage), ("le", str(bound))))
+                lines.append(f"{metric}_bucket{labels} {cumulative}")
+            labels = _format_labels((("stage", stage),))
+            lines.append(f"{metric}_sum{labels} {total}")
+            lines.append(f"{metric}_count{labels} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def get_metrics() -> MetricsBackend:
+    """
+    Returns the backend set by "VERIFY_EMAIL_METRICS_BACKEND".
+
+    One instance is kept per dotted path for the life of the process, so the recorded values
+    survive unrelated setting changes.
+    """
+    path = get_settings().metrics_backend
+    backend = _backends.get(path)
+    if backend is None:
+        with _backends_lock:
+            backend = _backends.get(path)
+            if backend is None:
+                backend = _backends[path] = import_string(path)()
+    return backend
@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.db import migrations
+
+from verify_email.models import add_lower_email_index, remove_lower_email_index
+
+
+def create_index(apps, schema_editor):
+    # opt-in: the index lives on the user table, which is not owned by this app
+    if getattr(settings, "VERIFY_EMAIL_CASE_INSENSITIVE_EMAIL", False):
+        add_lower_email_index(schema_editor, apps.get_model(settings.AUTH_USER_MODEL))
+
+
+def drop_index(apps, schema_editor):
+    remove_lower_email_index(schema_editor, apps.get_model(settings.AUTH_USER_MODEL))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("verify_email", "0002_outboxmessage"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
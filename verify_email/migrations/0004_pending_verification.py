@@ -0,0 +1,82 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:19
+
+import hashlib
+
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def get_email_digest(email):
+    # frozen copy of verify_email.token_manager.get_email_digest at the time of this migration
+    return hashlib.sha256(str(email).lower().encode("utf-8")).hexdigest()
+
+
+def delete_verified_counters(apps, schema_editor):
+    # the removed post_save receiver created a counter for every user, only the ones of users
+    # who never verified are pending verifications
+    LinkCounter = apps.get_model("verify_email", "LinkCounter")
+    LinkCounter.objects.filter(
+        Q(requester__is_active=True) | Q(requester__last_login__isnull=False)
+    ).delete()
+
+
+def backfill_pending_verifications(apps, schema_editor):
+    LinkCounter = apps.get_model("verify_email", "LinkCounter")
+    user_model = LinkCounter._meta.get_field("requester").related_model
+    # the removed receiver created the counters at signup, so "date_joined" is when the first
+    # link was sent rather than the time of the migration (custom user models may not have it)
+    has_date_joined = any(
+        field.name == "date_joined" for field in user_model._meta.concrete_fields
+    )
+    user_fields = ["email", "date_joined"] if has_date_joined else ["email"]
+    fields = ["email_digest", "created_at"] if has_date_joined else ["email_digest"]
+    batch = []
+    counters = (
+        LinkCounter.objects.select_related("requester")
+        .only(*(f"requester__{field}" for field in user_fields))
+        .order_by("pk")
+    )
+    for counter in counters.iterator(chunk_size=2000):
+        email = counter.requester.email
+        counter.email_digest = get_email_digest(email) if email else ""
+        if has_date_joined:
+            counter.created_at = counter.requester.date_joined
+        batch.append(counter)
+        if len(batch) >= 2000:
+            LinkCounter.objects.bulk_update(batch, fields)
+            batch = []
+    if batch:
+        LinkCounter.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("verify_email", "0003_lower_email_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="linkcounter",
+            name="created_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name="linkcounter",
+            name="email_digest",
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="linkcounter",
+            name="expires_at",
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name="linkcounter",
+            name="sent_count",
+            field=models.IntegerField(default=1),
+        ),
+        migrations.RunPython(delete_verified_counters, migrations.RunPython.noop),
+        migrations.RunPython(backfill_pending_verifications, migrations.RunPython.noop),
+    ]
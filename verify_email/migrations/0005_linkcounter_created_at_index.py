@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:21
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("verify_email", "0004_pending_verification"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="linkcounter",
+            name="created_at",
+            field=models.DateTimeField(
+                db_index=True, default=django.utils.timezone.now
+            ),
+        ),
+    ]
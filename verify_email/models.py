@@ -1,12 +1,70 @@
+import logging
+
 from django.db import models
+from django.db.models.functions import Lower
 from django.contrib.auth import get_user_model
+from django.core.mail import EmailMultiAlternatives
+from django.utils import timezone
 
 USER = get_user_model()
 
+LOWER_EMAIL_INDEX_NAME = "verify_email_lower_email_idx"
+
+logger = logging.getLogger(__name__)
+
+
+def lower_email_index() -> models.Index:
+    """
+    The functional "LOWER(email)" index used by the case-insensitive email lookups.
+    """
+    return models.Index(Lower("email"), name=LOWER_EMAIL_INDEX_NAME)
+
+
+def add_lower_email_index(schema_editor, user_model) -> bool:
+    """
+    Creates the "LOWER(email)" index on the user table if the database supports it.
+    Returns True if the index was created.
+    """
+    connection = schema_editor.connection
+    if not connection.features.supports_expression_indexes:
+        logger.warning(
+            f"{connection.vendor} does not support expression indexes, "
+            f"{LOWER_EMAIL_INDEX_NAME} was not created."
+        )
+        return False
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(
+            cursor, user_model._meta.db_table
+        )
+    if LOWER_EMAIL_INDEX_NAME in constraints:
+        return False
+    schema_editor.add_index(user_model, lower_email_index())
+    return True
+
+
+def remove_lower_email_index(schema_editor, user_model) -> bool:
+    """
+    Drops the "LOWER(email)" index from the user table if it exists.
+    Returns True if the index was dropped.
+    """
+    connection = schema_editor.connection
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(
+            cursor, user_model._meta.db_table
+        )
+    if LOWER_EMAIL_INDEX_NAME not in constraints:
+        return False
+    schema_editor.remove_index(user_model, lower_email_index())
+    return True
+
 
 class LinkCounter(models.Model):
     """
-    Represents a count of links sent by a user.
+    Represents a pending verification: the count of links sent to a user who hasn't verified yet.
+
+    A row is created when a verification link is sent and deleted when the user is activated,
+    so the table only grows with the outstanding verifications, not with the total users.
+    Verification and resend look the row up by "email_digest" instead of searching the user table.
 
     Attributes
     ----------
@@ -14,6 +72,12 @@ class LinkCounter(models.Model):
         A one-to-one relationship with the user who made the request.
     sent_count : int
         The total number of links sent by the requester.
+    email_digest : str
+        SHA-256 hex digest of the lower-cased email the link was sent to.
+    created_at : DateTimeField
+        When the first link was sent.
+    expires_at : DateTimeField
+        When the last sent link expires, None if links don't expire ("EXPIRE_AFTER").
 
     Methods
     -------
@@ -25,7 +89,10 @@ class LinkCounter(models.Model):
     """
 
     requester = models.OneToOneField(USER, on_delete=models.CASCADE)
-    sent_count = models.IntegerField()
+    sent_count = models.IntegerField(default=1)
+    email_digest = models.CharField(max_length=64, blank=True, db_index=True)
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
 
     def __str__(self) -> str:
         """
@@ -48,3 +115,91 @@ class LinkCounter(models.Model):
             The username of the requester.
         """
         return str(self.requester.get_username())
+
+
+class OutboxMessage(models.Model):
+    """
+    A verification email waiting to be sent by the "verify_email_drain_outbox" command.
+
+    Rows are inserted instead of sending the email when "VERIFY_EMAIL_DISPATCH" is set to "outbox",
+    so the request never waits on the mail server and a message is never lost if the worker dies.
+
+    Attributes
+    ----------
+    recipient : EmailField
+        The address the message is sent to.
+    subject, body, html_message, from_email :
+        The rendered email.
+    status : CharField
+        One of "pending", "sent" or "failed".
+    attempts : int
+        The number of failed attempts so far.
+    next_attempt_at : DateTimeField
+        The message is not picked up by the drain command before this time.
+    last_error : TextField
+        The error of the last failed attempt.
+    """
+
+    PENDING = "pending"
+    SENT = "sent"
+    FAILED = "failed"
+    STATUS_CHOICES = [(PENDING, "Pending"), (SENT, "Sent"), (FAILED, "Failed")]
+
+    recipient = models.EmailField(max_length=254)
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    html_message = models.TextField(blank=True)
+    from_email = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["status", "next_attempt_at"],
+                name="verify_email_outbox_due_idx",
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return f"{self.recipient} ({self.status})"
+
+    @classmethod
+    def enqueue(cls, message: EmailMultiAlternatives) -> "OutboxMessage":
+        """
+        Stores an email message with a single recipient in the outbox.
+        """
+        html_message = next(
+            (
+                content
+                for content, mimetype in getattr(message, "alternatives", [])
+                if mimetype == "text/html"
+            ),
+            "",
+        )
+        return cls.objects.create(
+            recipient=message.to[0],
+            subject=message.subject,
+            body=message.body,
+            html_message=html_message,
+            from_email=message.from_email,
+        )
+
+    def to_message(self, connection=None) -> EmailMultiAlternatives:
+        """
+        Builds the email message back from the stored row.
+        """
+        message = EmailMultiAlternatives(
+            self.subject,
+            self.body,
+            from_email=self.from_email,
+            to=[self.recipient],
+            connection=connection,
+        )
+        if self.html_message:
+            message.attach_alternative(self.html_message, "text/html")
+        return message
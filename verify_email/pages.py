@@ -0,0 +1,85 @@
+import hashlib
+
+from django.http import HttpResponse
+from django.shortcuts import render
+from django.template.loader import get_template, render_to_string
+from django.utils.cache import (
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+    quote_etag,
+)
+from django.utils.translation import get_language
+
+from .app_configurations import get_settings
+
+__all__ = ["clear_page_cache", "render_form_page", "render_static_page"]
+
+# (template name, status, language, context items) -> rendered body
+_page_cache = {}
+
+
+def clear_page_cache():
+    _page_cache.clear()
+
+
+def _has_pending_messages(request):
+    storage = getattr(request, "_messages", None)
+    return storage is not None and len(storage) > 0
+
+
+def render_static_page(request, template_name, context, status=200):
+    """
+    Renders a result page whose context is the same for every request, e.g. "Invalid Link".
+
+    When "VERIFY_EMAIL_CACHE_PAGES" is True, the body is rendered once per template, status,
+    language and context, and served from a process local cache afterwards. It is rendered
+    without the request (no context processors, no "user", "csrf_token"...), so that a page
+    served to every visitor can't hold the data of the first one. The cache is skipped in DEBUG
+    and when the request has flash messages waiting to be displayed by the page.
+    """
+    config = get_settings()
+    if config.debug or not config.cache_pages or _has_pending_messages(request):
+        return render(request, template_name, context, status=status)
+
+    key = (template_name, status, get_language(), tuple(sorted(context.items())))
+    content = _page_cache.get(key)
+    if content is None:
+        content = _page_cache[key] = render_to_string(template_name, context)
+    return HttpResponse(content, status=status)
+
+
+def _form_page_etag(request, template_name):
+    csrf_secret = request.META.get("CSRF_COOKIE")
+    if not csrf_secret:
+        return None
+    template = get_template(template_name)
+    source = getattr(getattr(template, "template", None), "source", "")
+    digest = hashlib.sha256(
+        "\0".join((template_name, source, get_language() or "", csrf_secret)).encode()
+    ).hexdigest()
+    # weak: the csrf token in the form is masked differently on every render
+    return f'W/"{digest[:32]}"'
+
+
+def render_form_page(request, template_name, context):
+    """
+    Renders a GET form page with an ETag, the page only changes with the template, the language
+    and the csrf secret of the client. A matching If-None-Match gets a 304 without rendering.
+    """
+    if _has_pending_messages(request):
+        return render(request, template_name, context)
+
+    etag = _form_page_etag(request, template_name)
+    response = None
+    if etag is not None:
+        response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = render(request, template_name, context)
+        # rendering the csrf token may have just created the client's secret
+        etag = etag or _form_page_etag(request, template_name)
+    if etag is not None:
+        response.headers["ETag"] = quote_etag(etag)
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ("Cookie", "Accept-Language"))
+    return response
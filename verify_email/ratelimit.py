@@ -0,0 +1,123 @@
+import hashlib
+import time
+from dataclasses import dataclass
+
+from django.core.cache import caches
+
+from .app_configurations import get_settings
+from .errors import RateLimited
+
+__all__ = [
+    "TokenBucket",
+    "alimit_client",
+    "alimit_email",
+    "get_client_ip",
+    "limit_client",
+    "limit_email",
+]
+
+
+@dataclass(frozen=True)
+class TokenBucket:
+    """
+    A token bucket stored in the django cache: "capacity" requests are allowed at once,
+    and the bucket refills at "capacity" requests per "period" seconds.
+
+    Each bucket is a single cache entry (tokens left, time of the last update) which expires
+    once it would be full again. The read and the write are not atomic, concurrent requests
+    may occasionally both take the last token, which is fine to throttle abuse.
+    """
+
+    scope: str
+    capacity: int
+    period: float
+    cache_alias: str = "default"
+
+    def _key(self, value: str) -> str:
+        digest = hashlib.sha256(value.encode()).hexdigest()[:32]
+        return f"verify_email:ratelimit:{self.scope}:{digest}"
+
+    def _take(self, state, now):
+        """
+        Returns (new state, seconds to wait or 0 if a token was taken).
+        """
+        tokens, updated_at = state if state else (self.capacity, now)
+        tokens = min(
+            self.capacity,
+            tokens + (now - updated_at) * self.capacity / self.period,
+        )
+        if tokens < 1:
+            return (tokens, now), (1 - tokens) * self.period / self.capacity
+        return (tokens - 1, now), 0
+
+    def consume(self, value: str) -> float:
+        """
+        Takes a token from the bucket of "value", returns 0 if there was one,
+        otherwise the number of seconds until the next token.
+        """
+        cache = caches[self.cache_alias]
+        key = self._key(value)
+        state, retry_after = self._take(cache.get(key), time.time())
+        cache.set(key, state, timeout=int(self.period) + 1)
+        return retry_after
+
+    async def aconsume(self, value: str) -> float:
+        cache = caches[self.cache_alias]
+        key = self._key(value)
+        state, retry_after = self._take(await cache.aget(key), time.time())
+        await cache.aset(key, state, timeout=int(self.period) + 1)
+        return retry_after
+
+
+def get_client_ip(request) -> str:
+    """
+    Returns REMOTE_ADDR, or the last address of "VERIFY_EMAIL_RATE_LIMIT_IP_HEADER"
+    (e.g. "HTTP_X_FORWARDED_FOR") when the app runs behind a proxy which sets it.
+    """
+    header = get_settings().rate_limit_ip_header
+    if header and request.META.get(header):
+        return request.META[header].split(",")[-1].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def _get_bucket(scope):
+    config = get_settings()
+    rate = getattr(config, f"rate_limit_{scope}")
+    if not rate:
+        return None
+    return TokenBucket(scope, rate[0], rate[1], config.rate_limit_cache)
+
+
+def _check(retry_after, scope):
+    if retry_after:
+        raise RateLimited(f"Too many requests by {scope}", retry_after=retry_after)
+
+
+def limit_client(request) -> None:
+    """
+    Raises RateLimited if the client went past "VERIFY_EMAIL_RATE_LIMIT_IP".
+    """
+    bucket = _get_bucket("ip")
+    if bucket is not None:
+        _check(bucket.consume(get_client_ip(request)), "ip")
+
+
+def limit_email(email: str) -> None:
+    """
+    Raises RateLimited if "VERIFY_EMAIL_RATE_LIMIT_EMAIL" requests were already made for this email.
+    """
+    bucket = _get_bucket("email")
+    if bucket is not None and email:
+        _check(bucket.consume(email.strip().lower()), "email")
+
+
+async def alimit_client(request) -> None:
+    bucket = _get_bucket("ip")
+    if bucket is not None:
+        _check(await bucket.aconsume(get_client_ip(request)), "ip")
+
+
+async def alimit_email(email: str) -> None:
+    bucket = _get_bucket("email")
+    if bucket is not None and email:
+        _check(await bucket.aconsume(email.strip().lower()), "email")
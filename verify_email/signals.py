@@ -1,22 +1,20 @@
-import logging
-
-from django.db.models.signals import post_save
+from django.core.signals import setting_changed
 from django.dispatch import receiver
 
-from .models import LinkCounter, USER
-
-logger = logging.getLogger(__name__)
-
-
-@receiver(post_save, sender=USER)
-def increase_count(sender, instance, created, **kwargs):
-    if created:
-        LinkCounter.objects.create(requester=instance, sent_count=1)
+from .app_configurations import SETTING_NAMES, clear_settings
+from .backends import close_pools
+from .dispatch import shutdown_executor
+from .pages import clear_page_cache
 
 
-@receiver(post_save, sender=USER)
-def save_count(sender, instance, **kwargs):
-    try:
-        instance.linkcounter.save()
-    except Exception as err:
-        logger.error(err)
+@receiver(setting_changed)
+def reload_settings(sender, setting, **kwargs):
+    # the cached pages also depend on TEMPLATES, LANGUAGES...
+    clear_page_cache()
+    # the pooled connections were opened with the EMAIL_* settings
+    if setting.startswith(("EMAIL_", "VERIFY_EMAIL_POOL")):
+        close_pools()
+    if setting in SETTING_NAMES:
+        clear_settings()
+        if setting.startswith("VERIFY_EMAIL_DISPATCH"):
+            shutdown_executor()
@@ -1,19 +1,125 @@
 # verify_email_tests/test_verify_email.py
+import hmac
+import json
+import os
+import smtplib
+import socket
+import socketserver
+import tempfile
+import threading
 import time
+from datetime import timedelta
+from io import StringIO
 
-from django.test import TestCase, override_settings
+from django.db import OperationalError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.test import (
+    AsyncRequestFactory,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.html import escape, strip_tags
+from django.utils.http import urlsafe_base64_decode, urlsafe_base64_encode
 from django.contrib.auth import get_user_model
-from verify_email.email_handler import ActivationMailManager
-from verify_email.token_manager import TokenManager, SafeURL, ActivationLinkManager
-from django.core import mail
+from verify_email.email_handler import ActivationMailManager, html_to_text
+from verify_email.token_manager import TokenManager, SafeURL, ActivationLinkManager, encode_user_pk, get_email_digest
+from unittest import mock
+
+from django.contrib.auth.tokens import default_token_generator
+from django.core import mail, signing
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
 from django.conf import settings
-from verify_email.app_configurations import GetFieldFromSettings
+from verify_email import backends, token_manager
+from verify_email.app_configurations import (
+    GetFieldFromSettings,
+    VerifyEmailSettings,
+    get_settings,
+    get_shared_instance,
+)
+from verify_email.confirm import UserActivationProcess
+from verify_email.errors import DecodingFailed, DispatchQueueFull, InvalidToken, UserNotFound, WrongTimeInterval
+from verify_email.dispatch import BoundedExecutor, adispatch_message, get_executor, shutdown_executor
+from verify_email.models import LOWER_EMAIL_INDEX_NAME, LinkCounter, OutboxMessage
+from verify_email.metrics import get_metrics
+from verify_email.pages import render_static_page
+from verify_email.views import metrics_view, request_new_link_async, verify_and_activate_user_async
 
 
 User = get_user_model()
 
 
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    """Speaks just enough SMTP for Django's smtp backend, the received messages go to server.messages."""
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply("220 localhost fake smtp")
+        sender, recipients = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.reply("250-localhost")
+                self.reply("250 8BITMIME")
+            elif verb == "HELO":
+                self.reply("250 localhost")
+            elif verb == "MAIL":
+                sender, recipients = command[10:], []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command[8:])
+                self.reply("250 OK")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while (line := self.rfile.readline()) not in (b".\r\n", b""):
+                    data.append(line)
+                self.server.messages.append((sender, recipients, b"".join(data)))
+                self.reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeSMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.port = self.server_address[1]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
 class VerifyEmailTests(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(
@@ -23,6 +129,7 @@ class VerifyEmailTests(TestCase):
         )
         self.user.is_active = False
         self.user.save()
+        cache.clear()
 
     def test_send_verification_email(self):
         """Test that verification email is sent."""
@@ -30,6 +137,457 @@ class VerifyEmailTests(TestCase):
         self.assertIsNotNone(response)
         self.assertEquals(len(mail.outbox), 1)
 
+    def test_plain_text_part_matches_stripped_html(self):
+        """Test that the cached plain-text part is the same as strip_tags on the html."""
+        for _ in range(2):
+            ActivationMailManager.send_verification_link(self.user)
+        for message in mail.outbox:
+            html = message.alternatives[0][0]
+            self.assertEqual(message.body, strip_tags(html))
+
+        for link in ('/verify/a/b/', '/verify/c/d/?x=1&y=2'):
+            html = f'<p>Open <a href="{escape(link)}">{escape(link)}</a></p>'
+            self.assertEqual(html_to_text(html, link), strip_tags(html))
+
+    def test_send_verification_links_in_bulk(self):
+        """Test that bulk sending reaches every user over a single connection."""
+        users = [self.user] + [
+            User.objects.create_user(
+                username=f'bulkuser{i}', email=f'bulkuser{i}@example.com', password='testpass'
+            )
+            for i in range(3)
+        ]
+        backend = type(mail.get_connection())
+        # every connection made for the call, whoever makes it, is an instance of the backend
+        with mock.patch.object(backend, '__init__', autospec=True, side_effect=backend.__init__) as new_connection, \
+                mock.patch.object(backend, 'open', autospec=True, side_effect=backend.open) as open_connection:
+            sent = ActivationMailManager.send_verification_links(users)
+        new_connection.assert_called_once()
+        open_connection.assert_called_once()
+        self.assertEqual(sent, 4)
+        self.assertEqual(len(mail.outbox), 4)
+        self.assertEqual(User.objects.filter(is_active=True).count(), 0)
+        self.assertEqual(LinkCounter.objects.count(), 4)
+
+    def test_generate_tokens_for_users(self):
+        """Test that batch tokens are the same as the ones made one user at a time, and generated lazily."""
+        users = [self.user] + [
+            User.objects.create_user(username=f'batchuser{i}', email=f'batchuser{i}@example.com', password='x')
+            for i in range(2)
+        ]
+        now = timezone.now().replace(tzinfo=None)
+        for expire_after in (None, '1h'):
+            with override_settings(EXPIRE_AFTER=expire_after), \
+                    mock.patch.object(default_token_generator, '_now', return_value=now), \
+                    mock.patch.object(TokenManager, 'timestamp', return_value='1abcde'):
+                manager = TokenManager()
+                batch = manager.generate_tokens_for_users(iter(users), base_url='https://example.com/')
+                user, token, link = next(batch)
+                self.assertIs(user, self.user)
+                self.assertEqual(token, manager.generate_token_for_user(self.user))
+                self.assertEqual(
+                    link,
+                    'https://example.com' + ActivationLinkManager.generate_link(token, self.user.email, self.user),
+                )
+                self.assertEqual(
+                    [token for _, token, _ in batch],
+                    [manager.generate_token_for_user(user) for user in users[1:]],
+                )
+
+    def test_generate_tokens_for_users_mirrors_installed_django(self):
+        """Test that the batch tokens pass Django's own checks, so the fallback is never taken."""
+        # fails after a Django upgrade which changed the internals mirrored by
+        # "_make_batch_token_function", the speed-up would otherwise be lost silently
+        for expire_after in (None, '1h'):
+            with self.subTest(expire_after=expire_after), override_settings(EXPIRE_AFTER=expire_after), \
+                    self.assertNoLogs('verify_email.token_manager', 'ERROR'):
+                list(TokenManager().generate_tokens_for_users([self.user]))
+
+    @override_settings(EXPIRE_AFTER='1h')
+    def test_generate_tokens_for_users_falls_back_when_django_changes(self):
+        """Test that batch tokens which don't pass Django's own checks are replaced by regular tokens."""
+        manager = TokenManager()
+        wrong_hmac = lambda hmac_self, value: hmac.new(b'wrong key', force_bytes(value), 'sha256')
+        with mock.patch.object(token_manager._SaltedHMAC, '__call__', wrong_hmac), \
+                self.assertLogs('verify_email.token_manager', 'ERROR'):
+            tokens = [token for _, token, _ in manager.generate_tokens_for_users([self.user, self.user])]
+        for token in tokens:
+            self.assertEqual(manager.decrypt_token_and_get_user(SafeURL.perform_encoding(self.user.email), token), self.user)
+
+    @override_settings(VERIFY_EMAIL_DISPATCH="threadpool", VERIFY_EMAIL_DISPATCH_WORKERS=2)
+    def test_send_verification_email_in_background(self):
+        """Test that the threadpool dispatch mode sends the email off the request thread."""
+        ActivationMailManager.send_verification_link(self.user)
+        shutdown_executor()
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(
+        VERIFY_EMAIL_DISPATCH='threadpool',
+        VERIFY_EMAIL_DISPATCH_WORKERS=1,
+        VERIFY_EMAIL_DISPATCH_QUEUE_SIZE=0,
+        VERIFY_EMAIL_DISPATCH_BACKPRESSURE='raise',
+    )
+    def test_resend_with_full_dispatch_queue_fails(self):
+        """Test that DispatchQueueFull reaches the resend view as an error page, no email is sent."""
+        user_token = TokenManager().generate_token_for_user(self.user)
+        link = ActivationLinkManager.generate_link(user_token, self.user.email)
+        user_email, user_token = link.strip('/').split('/')[-2:]
+        release = threading.Event()
+        get_executor().submit(release.wait)
+        try:
+            with self.assertLogs('verify_email', 'ERROR') as logs:
+                resp = self.client.get(reverse('request-new-link-from-token', args=[user_email, user_token]))
+        finally:
+            release.set()
+        self.assertEqual(resp.status_code, 403)
+        self.assertIn(b'Failed!', resp.content)
+        self.assertIn('Verification email queue is full', '\n'.join(logs.output))
+        self.assertEqual(len(mail.outbox), 0)
+
+    @override_settings(VERIFY_EMAIL_DISPATCH="outbox")
+    def test_outbox_is_drained_by_command(self):
+        """Test that outbox dispatch only stores the email until the drain command sends it."""
+        ActivationMailManager.send_verification_link(self.user)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.PENDING).count(), 1)
+
+        call_command('verify_email_drain_outbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+        self.assertEqual(OutboxMessage.objects.filter(status=OutboxMessage.SENT).count(), 1)
+
+    def test_outbox_drain_keeps_sent_messages_when_interrupted(self):
+        """Test that messages sent before a crash stay sent, and the others wait for the lease to expire."""
+        recipients = [f'outbox{i}@example.com' for i in range(3)]
+        for recipient in recipients:
+            OutboxMessage.objects.create(recipient=recipient, subject='S', body='B', from_email='f@example.com')
+        backend = type(mail.get_connection())
+        send_messages = backend.send_messages
+
+        def crash_on_second_message(connection, messages):
+            if messages[0].to == [recipients[1]]:
+                raise KeyboardInterrupt
+            return send_messages(connection, messages)
+
+        with mock.patch.object(backend, 'send_messages', crash_on_second_message):
+            with self.assertRaises(KeyboardInterrupt):
+                call_command('verify_email_drain_outbox', '--lease', '60', stdout=StringIO())
+        self.assertEqual(
+            list(OutboxMessage.objects.order_by('pk').values_list('status', flat=True)),
+            [OutboxMessage.SENT, OutboxMessage.PENDING, OutboxMessage.PENDING],
+        )
+        # still leased, nothing to drain yet
+        call_command('verify_email_drain_outbox', stdout=StringIO())
+        self.assertEqual(len(mail.outbox), 1)
+
+        OutboxMessage.objects.filter(status=OutboxMessage.PENDING).update(next_attempt_at=timezone.now())
+        call_command('verify_email_drain_outbox', stdout=StringIO())
+        self.assertEqual(sorted(message.to[0] for message in mail.outbox), recipients)
+
+    def test_settings_snapshot_follows_setting_changes(self):
+        """Test that the shared settings snapshot is rebuilt when a setting changes."""
+        snapshot = get_settings()
+        self.assertIs(snapshot, get_settings())
+        with override_settings(EXPIRE_AFTER="5m"):
+            self.assertEqual(get_settings().max_age, 300)
+            self.assertEqual(TokenManager().max_age, 300)
+        self.assertEqual(get_settings(), snapshot)
+
+    def test_shared_instances_are_rebuilt_on_setting_change(self):
+        process = get_shared_instance(UserActivationProcess)
+        self.assertIs(process, get_shared_instance(UserActivationProcess))
+        self.assertIs(process.token_manager, get_shared_instance(TokenManager))
+        with override_settings(EXPIRE_AFTER="1h"):
+            rebuilt = get_shared_instance(UserActivationProcess)
+            self.assertIsNot(rebuilt, process)
+            self.assertEqual(rebuilt.token_manager.max_age, 3600)
+
+    def test_settings_snapshot_rejects_bad_interval(self):
+        with override_settings(EXPIRE_AFTER="5x"):
+            with self.assertRaises(WrongTimeInterval):
+                VerifyEmailSettings.from_settings()
+
+    def test_verify_success_query_count(self):
+        ActivationLinkManager().register_pending_verification(self.user, self.user.email)
+        user_token = TokenManager().generate_token_for_user(self.user)
+        user_email = SafeURL.perform_encoding(self.user.email)
+        # select pending verification + user, update user, delete pending verification
+        with self.assertNumQueries(3):
+            user = UserActivationProcess.activate_user(user_email, user_token)
+        self.assertTrue(user.is_active)
+        self.assertFalse(LinkCounter.objects.filter(requester=self.user).exists())
+
+    @override_settings(VERIFY_EMAIL_LINK_FORMAT='pk')
+    def test_pk_link_is_resolved_by_primary_key(self):
+        """Test that links in the pk format are verified with a primary key lookup, and old links still work."""
+        ActivationMailManager.send_verification_link(self.user)
+        user_token = TokenManager().generate_token_for_user(self.user)
+        link = ActivationLinkManager.generate_link(user_token, self.user.email, self.user)
+        user_email, user_token = link.strip('/').split('/')[-2:]
+        self.assertTrue(user_email.startswith('pk.'))
+        self.assertIn(user_email, mail.outbox[0].body + mail.outbox[0].alternatives[0][0])
+
+        # a link with an altered primary key does not match the token
+        with self.assertRaises(UserNotFound):
+            UserActivationProcess.activate_user(encode_user_pk(self.user.pk + 1000), user_token)
+        User.objects.create_user(username='other', email='other@example.com', password='x', is_active=False)
+        with self.assertRaises(InvalidToken):
+            UserActivationProcess.activate_user(encode_user_pk(self.user.pk + 1), user_token)
+
+        # select user, update user, delete pending verification
+        with self.assertNumQueries(3):
+            user = UserActivationProcess.activate_user(user_email, user_token)
+        self.assertTrue(user.is_active)
+
+    @override_settings(VERIFY_EMAIL_LINK_FORMAT='pk')
+    def test_email_link_still_works_with_pk_format(self):
+        user_token = TokenManager().generate_token_for_user(self.user)
+        user = UserActivationProcess.activate_user(SafeURL.perform_encoding(self.user.email), user_token)
+        self.assertTrue(user.is_active)
+
+    @override_settings(VERIFY_EMAIL_LINK_FORMAT='compact')
+    def test_compact_link(self):
+        """Test that compact links are short, verified with one query and rejected once used."""
+        ActivationMailManager.send_verification_link(self.user)
+        user_token = TokenManager().generate_token_for_user(self.user)
+        link = ActivationLinkManager.generate_link(user_token, self.user.email, self.user)
+        self.assertEqual(link, f'/verification/user/verify-email/c/{user_token}/')
+        self.assertIn('/verification/user/verify-email/c/', mail.outbox[0].alternatives[0][0])
+        self.assertLess(len(user_token), 60)
+
+        # select user, update user, delete pending verification
+        with self.assertNumQueries(3):
+            user = UserActivationProcess.activate_user('c', user_token)
+        self.assertTrue(user.is_active)
+        # the last login set on activation changes the state hash of the user
+        with self.assertRaises(InvalidToken):
+            UserActivationProcess.activate_user('c', user_token)
+
+    @override_settings(VERIFY_EMAIL_LINK_FORMAT='compact')
+    def test_compact_link_tampered_or_expired(self):
+        user_token = TokenManager().generate_token_for_user(self.user)
+        raw = bytearray(urlsafe_base64_decode(user_token))
+        raw[2] ^= 1
+        with self.assertNumQueries(0):
+            with self.assertRaises(signing.BadSignature):
+                TokenManager().decrypt_token_and_get_user('c', urlsafe_base64_encode(bytes(raw)))
+            with self.assertRaises(DecodingFailed):
+                TokenManager().decrypt_token_and_get_user('c', 'not-a-token')
+
+        with override_settings(EXPIRE_AFTER='1m'):
+            manager = TokenManager()
+            old_token = manager.compact_signer.make_token(self.user, now=time.time() - 120)
+            with self.assertRaises(signing.SignatureExpired):
+                manager.decrypt_token_and_get_user('c', old_token)
+
+        # old-format links are still accepted
+        with override_settings(VERIFY_EMAIL_LINK_FORMAT='email'):
+            email_token = TokenManager().generate_token_for_user(self.user)
+        user = UserActivationProcess.activate_user(SafeURL.perform_encoding(self.user.email), email_token)
+        self.assertTrue(user.is_active)
+
+    @override_settings(VERIFY_EMAIL_LINK_FORMAT='compact', VERIFY_EMAIL_SIGNING_KEYS={'k1': 'first secret'})
+    def test_compact_link_signing_key_rotation(self):
+        """Test that tokens are checked with the key of their id only, and retired key ids are rejected."""
+        old_token = TokenManager().generate_token_for_user(self.user)
+        self.assertEqual(TokenManager().compact_signer.parse(old_token).key_id, 'k1')
+        with override_settings(VERIFY_EMAIL_SIGNING_KEYS=None):
+            unkeyed_token = TokenManager().compact_signer.make_token(self.user)
+
+        with override_settings(VERIFY_EMAIL_SIGNING_KEYS={'k2': 'second secret', 'k1': 'first secret'}):
+            manager = TokenManager()
+            self.assertEqual(manager.compact_signer.parse(manager.generate_token_for_user(self.user)).key_id, 'k2')
+            with mock.patch('verify_email.compact.hmac.new', wraps=hmac.new) as hmac_new:
+                self.assertEqual(manager.decrypt_token_and_get_user('c', old_token), self.user)
+            self.assertEqual(hmac_new.call_count, 1)
+
+        with override_settings(VERIFY_EMAIL_SIGNING_KEYS={'k2': 'second secret'}):
+            with self.assertNumQueries(0):
+                with self.assertRaises(signing.BadSignature):
+                    TokenManager().decrypt_token_and_get_user('c', old_token)
+            # tokens made before the key ring was configured are checked with HASHING_KEY
+            self.assertEqual(TokenManager().decrypt_token_and_get_user('c', unkeyed_token), self.user)
+
+        with override_settings(VERIFY_EMAIL_SIGNING_KEYS={'': 'secret'}):
+            with self.assertRaises(ImproperlyConfigured):
+                VerifyEmailSettings.from_settings()
+
+    @override_settings(VERIFY_EMAIL_LINK_FORMAT='compact')
+    def test_resend_from_compact_link(self):
+        user_token = TokenManager().generate_token_for_user(self.user)
+        request = RequestFactory().get('/')
+        self.assertTrue(ActivationMailManager.resend_verification_link(request, 'c', token=user_token))
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+
+    def test_verify_without_pending_verification(self):
+        """Test that users sent a link before pending verifications existed can still verify."""
+        user_token = TokenManager().generate_token_for_user(self.user)
+        user_email = SafeURL.perform_encoding(self.user.email)
+        # pending verification miss, select user + linkcounter, update user
+        with self.assertNumQueries(3):
+            user = UserActivationProcess.activate_user(user_email, user_token)
+        self.assertTrue(user.is_active)
+
+    def test_send_registers_pending_verification(self):
+        ActivationMailManager.send_verification_link(self.user)
+        counter = LinkCounter.objects.get(requester=self.user)
+        self.assertEqual(counter.sent_count, 1)
+        self.assertEqual(counter.email_digest, get_email_digest('TestUser@example.com'))
+
+    def test_user_save_does_not_touch_link_counter(self):
+        self.assertFalse(LinkCounter.objects.filter(requester=self.user).exists())
+        with self.assertNumQueries(1):
+            self.user.save()
+
+    def test_resend_creates_link_counter_lazily(self):
+        manager = ActivationLinkManager()
+        self.assertEqual(manager._get_sent_count(self.user), 1)
+        manager._increment_sent_counter(self.user)
+        self.assertEqual(LinkCounter.objects.get(requester=self.user).sent_count, 2)
+
+    def test_request_new_link_from_previous_link(self):
+        """Test that a new link is sent to the decoded email of a previously sent link."""
+        user_token = TokenManager().generate_token_for_user(self.user)
+        link = ActivationLinkManager.generate_link(user_token, self.user.email)
+        user_email, user_token = link.strip('/').split('/')[-2:]
+        resp = self.client.get(reverse('request-new-link-from-token', args=[user_email, user_token]))
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, [self.user.email])
+
+    @override_settings(EXPIRE_AFTER="1m")
+    def test_verify_expired_query_count(self):
+        two_minutes_ago = signing.b62_encode(int(time.time()) - 120)
+        with mock.patch.object(TokenManager, 'timestamp', return_value=two_minutes_ago):
+            user_token = TokenManager().generate_token_for_user(self.user)
+        user_email = SafeURL.perform_encoding(self.user.email)
+        ActivationLinkManager().register_pending_verification(self.user, self.user.email)
+        with self.assertNumQueries(1):
+            with self.assertRaises(signing.SignatureExpired):
+                TokenManager().decrypt_token_and_get_user(user_email, user_token)
+
+    @override_settings(EXPIRE_AFTER=None)
+    def test_verify_invalid_query_count(self):
+        other_user = User.objects.create_user(
+            username='otheruser', email='otheruser@example.com', password='testpass'
+        )
+        user_token = SafeURL.perform_encoding(default_token_generator.make_token(other_user))
+        user_email = SafeURL.perform_encoding(self.user.email)
+        ActivationLinkManager().register_pending_verification(self.user, self.user.email)
+        with self.assertNumQueries(1):
+            with self.assertRaises(InvalidToken):
+                TokenManager().decrypt_token_and_get_user(user_email, user_token)
+
+    @override_settings(VERIFY_EMAIL_CASE_INSENSITIVE_EMAIL=True)
+    def test_verify_with_mixed_case_email(self):
+        user_token = TokenManager().generate_token_for_user(self.user)
+        user_email = SafeURL.perform_encoding('TestUser@Example.COM')
+        user = UserActivationProcess.activate_user(user_email, user_token)
+        self.assertEqual(user.pk, self.user.pk)
+
+    def test_purge_unverified_users(self):
+        manager = ActivationLinkManager()
+        manager.register_pending_verification(self.user, self.user.email)
+        recent_user = User.objects.create_user(
+            username='recentuser', email='recentuser@example.com', password='testpass', is_active=False
+        )
+        manager.register_pending_verification(recent_user, recent_user.email)
+        LinkCounter.objects.filter(requester=self.user).update(
+            created_at=timezone.now() - timedelta(days=31)
+        )
+
+        out = StringIO()
+        call_command('verify_email_purge_unverified', '--older-than', '30d', '--dry-run', stdout=out)
+        self.assertIn('Would delete 1 ', out.getvalue())
+        self.assertTrue(User.objects.filter(pk=self.user.pk).exists())
+
+        call_command('verify_email_purge_unverified', '--older-than', '30d', '--batch-size', '1', stdout=out)
+        self.assertFalse(User.objects.filter(pk=self.user.pk).exists())
+        self.assertTrue(User.objects.filter(pk=recent_user.pk).exists())
+
+    def test_resend_pending_command(self):
+        """Test that pending users with retries left get a new link, and an interrupted run resumes."""
+        users = [self.user] + [
+            User.objects.create_user(
+                username=f'pendinguser{i}', email=f'pendinguser{i}@example.com', password='x', is_active=False
+            )
+            for i in range(3)
+        ]
+        ActivationLinkManager().register_pending_verifications(users)
+        # no retries left
+        LinkCounter.objects.filter(requester=users[1]).update(sent_count=3)
+
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = os.path.join(directory, 'resend.json')
+            with open(checkpoint, 'w') as file:
+                json.dump({'last_pk': str(users[0].pk), 'sent': 5}, file)
+
+            out = StringIO()
+            call_command(
+                'verify_email_resend_pending', '--base-url', 'https://example.com/', '--batch-size', '1',
+                '--workers', '2', '--checkpoint', checkpoint, stdout=out,
+            )
+            self.assertIn('Sent 7 verification link(s).', out.getvalue())
+            self.assertFalse(os.path.exists(checkpoint))
+
+        self.assertCountEqual([message.to[0] for message in mail.outbox], [users[2].email, users[3].email])
+        self.assertIn('https://example.com/verification/user/verify-email/', mail.outbox[0].alternatives[0][0])
+        self.assertEqual(
+            dict(LinkCounter.objects.values_list('requester__username', 'sent_count')),
+            {'testuser': 1, 'pendinguser0': 3, 'pendinguser1': 2, 'pendinguser2': 2},
+        )
+
+    def test_resend_pending_command_keeps_retry_of_failed_sends(self):
+        """Test that a failed send neither stops the run nor takes a retry from its user."""
+        other = User.objects.create_user(
+            username='pendingother', email='pendingother@example.com', password='x', is_active=False
+        )
+        ActivationLinkManager().register_pending_verifications([self.user, other])
+        backend = mail.get_connection()
+        send_messages = type(backend).send_messages
+        failures = iter([smtplib.SMTPServerDisconnected('dropped')] * 2)
+
+        def flaky_send_messages(connection, messages):
+            error = next(failures, None)
+            if error is not None:
+                raise error
+            return send_messages(connection, messages)
+
+        out, err = StringIO(), StringIO()
+        with mock.patch.object(type(backend), 'send_messages', flaky_send_messages):
+            call_command(
+                'verify_email_resend_pending', '--base-url', 'https://example.com', '--workers', '1',
+                stdout=out, stderr=err,
+            )
+        # the first email failed twice, the connection was reopened for the second one
+        self.assertIn('Sent 1 verification link(s).', out.getvalue())
+        self.assertIn('Failed to send 1 email(s)', err.getvalue())
+        self.assertEqual([message.to for message in mail.outbox], [[other.email]])
+        self.assertEqual(
+            dict(LinkCounter.objects.values_list('requester__username', 'sent_count')),
+            {'testuser': 1, 'pendingother': 2},
+        )
+
+    @override_settings(MAX_RETRIES=3)
+    def test_resend_pending_command_takes_retry_before_sending(self):
+        """Test that a resend requested while the command sends a link can't go past MAX_RETRIES."""
+        ActivationLinkManager().register_pending_verifications([self.user])
+        # the first link and two resends were sent, one retry is left
+        LinkCounter.objects.filter(requester=self.user).update(sent_count=3)
+        generate_tokens_for_users = TokenManager.generate_tokens_for_users
+        concurrent_resends = []
+
+        def generate_tokens_with_concurrent_resend(token_manager, users, base_url=None):
+            # a resend request made after the command picked the user, before the email is sent
+            concurrent_resends.append(ActivationLinkManager()._increment_sent_counter(self.user))
+            return generate_tokens_for_users(token_manager, users, base_url)
+
+        with mock.patch.object(TokenManager, 'generate_tokens_for_users', generate_tokens_with_concurrent_resend):
+            call_command('verify_email_resend_pending', '--base-url', 'https://example.com', stdout=StringIO())
+        self.assertEqual(concurrent_resends, [False])
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(LinkCounter.objects.get(requester=self.user).sent_count, 4)
+
     def test_verification_view_by_token_and_email(self):
         """Test the email verification view."""
         user_token = TokenManager().generate_token_for_user(self.user)
@@ -37,6 +595,125 @@ class VerifyEmailTests(TestCase):
         response = self.client.get(reverse('verify-email', args=[user_email, user_token]))
         self.assertEqual(response.status_code, 200)
 
+    @override_settings(VERIFY_EMAIL_CACHE_PAGES=True)
+    def test_invalid_link_page_is_served_from_cache(self):
+        """Test that identical error pages are rendered only once."""
+        url = reverse('verify-email', args=[SafeURL.perform_encoding(self.user.email), 'bad-token'])
+        first = self.client.get(url)
+        with mock.patch('verify_email.pages.render_to_string') as render:
+            second = self.client.get(url)
+        render.assert_not_called()
+        self.assertEqual(second.status_code, first.status_code)
+        self.assertEqual(second.content, first.content)
+
+    @override_settings(TEMPLATES=[{
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'OPTIONS': {
+            'context_processors': ['django.template.context_processors.request'],
+            'loaders': [('django.template.loaders.locmem.Loader', {'page.html': '{{ request.user }}|{{ status }}'})],
+        },
+    }])
+    def test_cached_page_does_not_depend_on_the_request(self):
+        """Test that a cached page can't hold the data of the visitor it was first rendered for."""
+        request = RequestFactory().get('/')
+        request.user = self.user
+        with override_settings(VERIFY_EMAIL_CACHE_PAGES=True):
+            response = render_static_page(request, 'page.html', {'status': 'Failed'})
+        self.assertEqual(response.content, b'|Failed')
+
+        # not cached by default, custom templates keep their request context
+        response = render_static_page(request, 'page.html', {'status': 'Failed'})
+        self.assertEqual(response.content, b'testuser|Failed')
+
+    @override_settings(MIDDLEWARE=settings.MIDDLEWARE + ['django.middleware.csrf.CsrfViewMiddleware'])
+    def test_request_new_email_page_etag(self):
+        """Test that the request new email form answers If-None-Match with a 304."""
+        url = reverse('request-new-link-from-email')
+        first = self.client.get(url)
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('private', first['Cache-Control'])
+        second = self.client.get(url, headers={'If-None-Match': first['ETag']})
+        self.assertEqual(second.status_code, 304)
+
+    @override_settings(
+        VERIFY_EMAIL_METRICS_BACKEND='verify_email.metrics.InMemoryMetrics',
+        VERIFY_EMAIL_METRICS_VIEW=True,
+    )
+    def test_metrics_are_recorded_and_exported(self):
+        """Test that the stages and the view outcome are recorded and exported for Prometheus."""
+        metrics = get_metrics()
+        metrics.reset()
+        token = TokenManager().generate_token_for_user(self.user)
+        self.client.get(ActivationLinkManager.generate_link(token, self.user.email))
+
+        self.assertEqual(metrics.counters[('verification', (('outcome', 'success'),))], 1)
+        for stage in ('token_generate', 'token_decode', 'db_lookup'):
+            self.assertEqual(metrics.timings[stage][2], 1)
+
+        resp = metrics_view(RequestFactory().get('/metrics/'))
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'verify_email_verification_total{outcome="success"} 1', resp.content)
+        self.assertIn(b'verify_email_stage_seconds_count{stage="db_lookup"} 1', resp.content)
+
+    @override_settings(VERIFY_EMAIL_RATE_LIMIT_EMAIL='2/h', VERIFY_EMAIL_RATE_LIMIT_IP='4/m')
+    def test_request_new_link_is_rate_limited(self):
+        """Test that over-limit requests get a 429 without touching the database or the mail backend."""
+        cache.clear()
+        url = reverse('request-new-link-from-email')
+        for _ in range(2):
+            self.assertEqual(self.client.post(url, {'email': self.user.email}).status_code, 200)
+        with self.assertNumQueries(0):
+            resp = self.client.post(url, {'email': self.user.email.upper()})
+        self.assertEqual(resp.status_code, 429)
+        self.assertIn('Retry-After', resp)
+        self.assertEqual(len(mail.outbox), 2)
+
+        # the client has one request left, then is limited whatever the email
+        self.assertEqual(self.client.post(url, {'email': 'other@example.com'}).status_code, 404)
+        self.assertEqual(self.client.post(url, {'email': 'other@example.com'}).status_code, 429)
+
+    @override_settings(VERIFY_EMAIL_RATE_LIMIT_EMAIL='1/h')
+    def test_request_new_link_from_link_is_rate_limited_by_email(self):
+        """Test that links of every format share the email bucket of the form."""
+        form_url = reverse('request-new-link-from-email')
+        for link_format in ('email', 'pk', 'compact'):
+            with self.subTest(link_format=link_format), override_settings(VERIFY_EMAIL_LINK_FORMAT=link_format):
+                cache.clear()
+                token = TokenManager().generate_token_for_user(self.user)
+                link = ActivationLinkManager.generate_link(token, self.user.email, self.user)
+                url = reverse('request-new-link-from-token', args=link.strip('/').split('/')[-2:])
+                self.assertEqual(self.client.get(url).status_code, 200)
+                self.assertEqual(self.client.get(url).status_code, 429)
+                self.assertEqual(self.client.post(form_url, {'email': self.user.email}).status_code, 429)
+                LinkCounter.objects.filter(requester=self.user).delete()
+
+    @override_settings(VERIFY_EMAIL_METRICS_BACKEND='verify_email.metrics.InMemoryMetrics')
+    def test_tampered_link_is_answered_from_negative_cache(self):
+        """Test that a link found bad is rejected again without decoding or querying."""
+        metrics = get_metrics()
+        metrics.reset()
+        token = TokenManager().generate_token_for_user(self.user)
+        url = reverse('verify-email', args=[SafeURL.perform_encoding(self.user.email), token[:-2] + 'xx'])
+
+        first = self.client.get(url)
+        with self.assertNumQueries(0), mock.patch.object(TokenManager, '_decode_link') as decode:
+            second = self.client.get(url)
+        decode.assert_not_called()
+        self.assertEqual(second.status_code, first.status_code)
+        self.assertEqual(metrics.counters[('negative_cache', (('result', 'hit'),))], 1)
+        self.assertEqual(metrics.counters[('negative_cache', (('result', 'miss'),))], 1)
+
+    def test_second_click_on_used_link_skips_user_table(self):
+        """Test that a link which already activated its user is answered from the consumed marker."""
+        token = TokenManager().generate_token_for_user(self.user)
+        link = ActivationLinkManager.generate_link(token, self.user.email)
+        self.assertEqual(self.client.get(link).status_code, 200)
+
+        with self.assertNumQueries(0):
+            resp = self.client.get(link)
+        self.assertEqual(resp.status_code, 200)
+        self.assertContains(resp, 'Already Verified!')
+
     def test_verification_link(self):
         user_token = TokenManager().generate_token_for_user(self.user)
         user_email = self.user.email
@@ -74,3 +751,221 @@ class VerifyEmailTests(TestCase):
         full_url = f"http://testserver{link}"
         resp = self.client.get(full_url)
         self.assertEquals(resp.status_code, 200)
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='testuser@example.com',
+            password='testpass'
+        )
+        self.user.is_active = False
+        self.user.save()
+        self.factory = AsyncRequestFactory()
+
+    async def test_async_verify_and_resend_over_smtp(self):
+        """Test the async views end to end, sending through a local fake SMTP server."""
+        with FakeSMTPServer() as server, override_settings(
+            EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+            EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=server.port,
+            EMAIL_USE_TLS=False,
+        ):
+            token = TokenManager().generate_token_for_user(self.user)
+            link = ActivationLinkManager.generate_link(token, self.user.email)
+            user_email, user_token = link.strip('/').split('/')[-2:]
+
+            path = reverse('request-new-link-from-token', args=[user_email, user_token])
+            resp = await request_new_link_async(self.factory.get(path), user_email, user_token)
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(server.messages), 1)
+            self.assertIn(self.user.email, server.messages[0][1][0])
+
+            resp = await verify_and_activate_user_async(self.factory.get(link), user_email, user_token)
+            self.assertEqual(resp.status_code, 200)
+        await self.user.arefresh_from_db()
+        self.assertTrue(self.user.is_active)
+        self.assertFalse(await LinkCounter.objects.filter(requester=self.user).aexists())
+
+
+    @override_settings(
+        VERIFY_EMAIL_DISPATCH='threadpool',
+        VERIFY_EMAIL_DISPATCH_WORKERS=1,
+        VERIFY_EMAIL_DISPATCH_QUEUE_SIZE=0,
+        VERIFY_EMAIL_DISPATCH_BACKPRESSURE='caller',
+    )
+    async def test_async_dispatch_with_full_queue_sends_off_the_event_loop(self):
+        """Test that the "caller" policy doesn't send on the event loop thread when the queue is full."""
+        release = threading.Event()
+        get_executor().submit(release.wait)
+        message = mock.Mock()
+        sender_threads = []
+        message.send.side_effect = lambda: sender_threads.append(threading.get_ident())
+        try:
+            await adispatch_message(message)
+        finally:
+            release.set()
+        self.assertEqual(len(sender_threads), 1)
+        self.assertNotEqual(sender_threads[0], threading.get_ident())
+
+
+class BoundedExecutorTests(SimpleTestCase):
+    def get_saturated_executor(self, backpressure):
+        executor = BoundedExecutor(max_workers=1, queue_size=0, backpressure=backpressure)
+        release = threading.Event()
+        executor.submit(release.wait)
+        self.addCleanup(executor.shutdown)
+        self.addCleanup(release.set)
+        return executor
+
+    def test_caller_policy_runs_the_job_in_the_calling_thread(self):
+        """Test that a job submitted to a full "caller" executor runs right away in the caller's thread."""
+        executor = self.get_saturated_executor('caller')
+        self.assertEqual(executor.submit(threading.get_ident), threading.get_ident())
+
+    def test_raise_policy_rejects_the_job(self):
+        """Test that a job submitted to a full "raise" executor is rejected without running."""
+        executor = self.get_saturated_executor('raise')
+        job = mock.Mock()
+        with self.assertRaises(DispatchQueueFull):
+            executor.submit(job)
+        job.assert_not_called()
+
+@override_settings(
+    EMAIL_BACKEND='verify_email.backends.PooledEmailBackend',
+    VERIFY_EMAIL_POOL_BACKEND='django.core.mail.backends.smtp.EmailBackend',
+    EMAIL_HOST='127.0.0.1',
+    EMAIL_USE_TLS=False,
+    VERIFY_EMAIL_POOL_SIZE=2,
+)
+class PooledEmailBackendTests(SimpleTestCase):
+    def send(self, count):
+        for i in range(count):
+            mail.send_mail('Subject', 'Body', 'from@example.com', [f'user{i}@example.com'])
+
+    def test_connections_are_reused_and_recycled(self):
+        with FakeSMTPServer() as server, override_settings(EMAIL_PORT=server.port, VERIFY_EMAIL_POOL_MAX_MESSAGES=3):
+            self.send(7)
+            self.assertEqual(len(server.messages), 7)
+            # recycled after 3 messages
+            self.assertEqual(server.connections, 3)
+
+            # a connection dropped by the server is found by the health check and replaced
+            (pool,) = backends._pools.values()
+            self.assertEqual(len(pool._idle), 1)
+            pool._idle[0].connection.connection.sock.shutdown(socket.SHUT_RDWR)
+            pool._idle[0].used_at -= 60
+            self.send(1)
+            self.assertEqual(len(server.messages), 8)
+            self.assertEqual(server.connections, 4)
+
+    def test_connections_are_shared_by_threads(self):
+        with FakeSMTPServer() as server, override_settings(EMAIL_PORT=server.port):
+            threads = [threading.Thread(target=self.send, args=(5,)) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(server.messages), 30)
+            self.assertLessEqual(server.connections, 2)
+
+
+class ResendCounterConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='testuser@example.com',
+            password='testpass'
+        )
+
+    @override_settings(MAX_RETRIES=3)
+    def test_limit_holds_under_parallel_requests(self):
+        """Test that parallel resend requests never go past MAX_RETRIES."""
+        manager = ActivationLinkManager()
+        workers = 10
+        barrier = threading.Barrier(workers)
+        results = []
+        errors = []
+
+        def resend():
+            try:
+                barrier.wait()
+                for _ in range(200):
+                    try:
+                        results.append(manager._increment_sent_counter(self.user))
+                        return
+                    except OperationalError as err:
+                        # SQLite's shared in-memory test database fails a write made while
+                        # another connection holds the table lock instead of waiting for it,
+                        # the conditional UPDATE changed nothing and is run again
+                        if 'locked' not in str(err):
+                            raise
+                        time.sleep(0.01)
+                raise AssertionError('The counter stayed locked')
+            except BaseException as err:
+                errors.append(err)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=resend) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), workers)
+        allowed = results.count(True)
+        self.assertEqual(allowed, 3)
+        self.assertEqual(LinkCounter.objects.get(requester=self.user).sent_count, 1 + allowed)
+
+
+class LowerEmailIndexTests(TransactionTestCase):
+    def get_indexes(self):
+        with connection.cursor() as cursor:
+            return connection.introspection.get_constraints(cursor, User._meta.db_table)
+
+    def test_index_command_creates_and_drops_index(self):
+        call_command('verify_email_email_index', stdout=StringIO())
+        if connection.features.supports_expression_indexes:
+            self.assertIn(LOWER_EMAIL_INDEX_NAME, self.get_indexes())
+        call_command('verify_email_email_index', '--drop', stdout=StringIO())
+        self.assertNotIn(LOWER_EMAIL_INDEX_NAME, self.get_indexes())
+
+
+class PendingVerificationMigrationTests(TransactionTestCase):
+    migrate_from = [('verify_email', '0003_lower_email_index')]
+    migrate_to = [('verify_email', '0004_pending_verification')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        # the other apps, e.g. auth, are at their latest migration
+        latest = [node for node in executor.loader.graph.leaf_nodes() if node[0] != 'verify_email']
+        return executor.loader.project_state(latest + targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_only_unverified_users_keep_a_pending_verification(self):
+        """Test that the counters of verified users are dropped and the others backfilled from the user."""
+        apps = self.migrate(self.migrate_from)
+        user_model = apps.get_model(settings.AUTH_USER_MODEL)
+        counter_model = apps.get_model('verify_email', 'LinkCounter')
+        date_joined = timezone.now() - timedelta(days=365)
+        pending = user_model.objects.create(
+            username='pending', email='Pending@Example.com', is_active=False, date_joined=date_joined
+        )
+        verified = user_model.objects.create(username='verified', email='verified@example.com', last_login=timezone.now())
+        deactivated = user_model.objects.create(
+            username='deactivated', email='deactivated@example.com', is_active=False, last_login=timezone.now()
+        )
+        for user in (pending, verified, deactivated):
+            counter_model.objects.create(requester_id=user.pk, sent_count=1)
+
+        apps = self.migrate(self.migrate_to)
+        (counter,) = apps.get_model('verify_email', 'LinkCounter').objects.all()
+        self.assertEqual(counter.requester_id, pending.pk)
+        self.assertEqual(counter.email_digest, get_email_digest('pending@example.com'))
+        self.assertEqual(counter.created_at, date_joined)
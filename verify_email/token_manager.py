@@ -1,38 +1,210 @@
+import hashlib
+import hmac
 import logging
 from dataclasses import dataclass, field
-from typing import Union, List
 from datetime import timedelta
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 from binascii import Error as BASE64ERROR
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 
+from django.conf import settings as django_settings
 from django.core import signing
+from django.core.exceptions import (
+    ImproperlyConfigured,
+    ObjectDoesNotExist,
+    ValidationError,
+)
+from django.db import connection
+from django.db.models import F, Value
+from django.db.models.functions import Lower
 from django.contrib.auth import get_user_model
 from django.contrib.auth.tokens import default_token_generator
+from django.utils import timezone
+from django.utils.encoding import force_bytes
+from django.utils.http import (
+    int_to_base36,
+    urlsafe_base64_decode,
+    urlsafe_base64_encode,
+)
 
 from .custom_types import User
-from .app_configurations import GetFieldFromSettings
+from .app_configurations import (
+    TIME_UNITS,
+    VerifyEmailSettings,
+    get_seconds,
+    get_settings,
+    get_shared_instance,
+)
+from .compact import COMPACT_LINK_MARKER, CompactSigner, CompactToken
+from .metrics import get_metrics
 from .errors import (
     UserAlreadyActive,
     MaxRetriesExceeded,
     UserNotFound,
-    WrongTimeInterval,
     InvalidToken,
     DecodingFailed,
 )
 
-__all__ = ["TokenManager"]
+__all__ = ["TokenManager", "filter_users_by_email", "get_email_digest"]
 
 logger = logging.getLogger(__name__)
 
+# the first verification email counts as one sent link
+INITIAL_SENT_COUNT = 1
+
+
+def filter_users_by_email(email: str, queryset=None):
+    """
+    Filters users by email.
+
+    With "VERIFY_EMAIL_CASE_INSENSITIVE_EMAIL" the lookup is "LOWER(email) = LOWER(<email>)", which
+    matches mixed-case addresses and can use the functional index created by the app's migrations.
+    """
+    if queryset is None:
+        queryset = get_user_model()._default_manager.all()
+    if not get_settings().case_insensitive_email:
+        return queryset.filter(email=email)
+    return queryset.alias(email_lower=Lower("email")).filter(
+        email_lower=Lower(Value(email))
+    )
+
+
+def emails_match(stored_email: str, email: str) -> bool:
+    """
+    Compares two emails the same way "filter_users_by_email" does.
+    """
+    if get_settings().case_insensitive_email:
+        return stored_email.lower() == email.lower()
+    return stored_email == email
+
+
+def get_email_digest(email: str) -> str:
+    """
+    Returns the SHA-256 hex digest of the lower-cased email, used to find pending verifications.
+    """
+    return hashlib.sha256(str(email).lower().encode("utf-8")).hexdigest()
+
 
 @dataclass
 class GeneralConfig:
-    settings: GetFieldFromSettings = field(default_factory=GetFieldFromSettings)
-    time_units: List[str] = field(default_factory=lambda: ["s", "m", "h", "d"])
+    settings: VerifyEmailSettings = field(default_factory=get_settings)
+    time_units: List[str] = field(default_factory=lambda: list(TIME_UNITS))
 
     def __post_init__(self):
-        self.max_age = self.settings.get("max_age", raise_exception=False)
-        self.max_retries = self.settings.get("max_retries") + 1
+        self.max_age = self.settings.max_age  # already in seconds
+        self.max_retries = self.settings.max_retries + 1
+
+
+# the email segment of a link starts with it when it holds the user's primary key instead,
+# "." is not in the url-safe base64 alphabet so it cannot start an encoded email
+PK_LINK_PREFIX = "pk."
+LINK_FORMATS = ("email", "pk", "compact")
+
+
+class LinkTarget(NamedTuple):
+    """
+    Who a verification link was sent to, "pk" for links in the "pk" format else "email".
+    """
+
+    pk: Optional[str] = None
+    email: Optional[str] = None
+
+    def __str__(self):
+        return f"pk {self.pk}" if self.pk is not None else str(self.email)
+
+
+def encode_user_pk(pk) -> str:
+    return PK_LINK_PREFIX + urlsafe_base64_encode(force_bytes(pk))
+
+
+def decode_link_target(encoded_email: str) -> Optional[LinkTarget]:
+    """
+    Decodes the email segment of a link, which holds either the encoded email or, for links
+    in the "pk" format, the encoded primary key of the user. Returns None if it can't be decoded.
+    """
+    if encoded_email.startswith(PK_LINK_PREFIX):
+        try:
+            pk = urlsafe_base64_decode(encoded_email[len(PK_LINK_PREFIX) :]).decode()
+        except (ValueError, TypeError):
+            return None
+        return LinkTarget(pk=pk)
+    email = SafeURL.perform_decoding(encoded_email)
+    return LinkTarget(email=email) if email else None
+
+
+def resolve_link_target(encoded_email: str, encoded_token: str) -> Optional[LinkTarget]:
+    """
+    Same as "decode_link_target", also resolving links in the "compact" format, whose primary key
+    is read from the token (its MAC is checked). Returns None if the link can't be decoded.
+    """
+    if encoded_email != COMPACT_LINK_MARKER:
+        return decode_link_target(encoded_email)
+    try:
+        token = get_shared_instance(TokenManager).compact_signer.parse(encoded_token)
+    except (DecodingFailed, signing.BadSignature):
+        return None
+    return LinkTarget(pk=token.pk)
+
+
+def _get_user_email(user) -> str:
+    return "" if user is None else getattr(user, user.get_email_field_name()) or ""
+
+
+def get_link_email(encoded_email: str, encoded_token: str) -> str:
+    """
+    Returns the email a link was sent to, whatever its format: links in the "pk" and "compact"
+    formats are resolved by looking their user up by primary key. Returns "" if the link can't
+    be decoded or its user doesn't exist.
+    """
+    target = resolve_link_target(encoded_email, encoded_token)
+    if target is None:
+        return ""
+    if target.pk is None:
+        return target.email
+    return _get_user_email(TokenManager._get_user_by_pk(target.pk))
+
+
+async def aget_link_email(encoded_email: str, encoded_token: str) -> str:
+    """
+    Async version of "get_link_email".
+    """
+    target = resolve_link_target(encoded_email, encoded_token)
+    if target is None:
+        return ""
+    if target.pk is None:
+        return target.email
+    return _get_user_email(await TokenManager._aget_user_by_pk(target.pk))
+
+
+def check_user_token(user: User, token) -> bool:
+    """
+    Checks a decoded link token against the user: a CompactToken is compared to the state of the
+    user, any other token is checked by "default_token_generator". Both are valid for
+    PASSWORD_RESET_TIMEOUT at most.
+    """
+    if isinstance(token, CompactToken):
+        return (
+            token.matches(user)
+            and token.age() <= django_settings.PASSWORD_RESET_TIMEOUT
+        )
+    return default_token_generator.check_token(user, token.split(":")[0])
+
+
+class _SaltedHMAC:
+    """
+    "django.utils.crypto.salted_hmac" with the key derived once: each call copies the keyed HMAC
+    instead of hashing the salt and the secret and keying a new HMAC again.
+    """
+
+    def __init__(self, key_salt: str, secret, algorithm: str):
+        hasher = getattr(hashlib, algorithm)
+        key = hasher(force_bytes(key_salt) + force_bytes(secret)).digest()
+        self._hmac = hmac.new(key, digestmod=hasher)
+
+    def __call__(self, value):
+        mac = self._hmac.copy()
+        mac.update(force_bytes(value))
+        return mac
 
 
 @dataclass
@@ -52,20 +224,143 @@ class SafeURL:
 @dataclass
 class ActivationLinkManager(GeneralConfig):
 
+    def _get_pending_values(self, user_email: str) -> dict:
+        expires_at = None
+        if self.max_age:
+            expires_at = timezone.now() + timedelta(seconds=self.max_age)
+        return {"email_digest": get_email_digest(user_email), "expires_at": expires_at}
+
+    def register_pending_verification(self, user: User, user_email: str) -> None:
+        """
+        Creates (or refreshes) the pending verification row of a user a link is sent to.
+        """
+        from .models import LinkCounter
+
+        LinkCounter.objects.update_or_create(
+            requester=user, defaults=self._get_pending_values(user_email)
+        )
+
+    def register_pending_verifications(self, users) -> None:
+        """
+        Same as "register_pending_verification" for many users, in a single query.
+        """
+        from .models import LinkCounter
+
+        conflict_target = {}
+        if connection.features.supports_update_conflicts_with_target:
+            conflict_target["unique_fields"] = ["requester"]
+        LinkCounter.objects.bulk_create(
+            [
+                LinkCounter(requester=user, **self._get_pending_values(user.email))
+                for user in users
+            ],
+            update_conflicts=True,
+            update_fields=["email_digest", "expires_at"],
+            **conflict_target,
+        )
+
+    @staticmethod
+    def clear_pending_verification(user: User) -> None:
+        """
+        Deletes the pending verification row of an activated user.
+        """
+        from .models import LinkCounter
+
+        if not ActivationLinkManager._known_without_pending_verification(user):
+            LinkCounter.objects.filter(requester=user).delete()
+
+    @staticmethod
+    async def aclear_pending_verification(user: User) -> None:
+        """
+        Async version of "clear_pending_verification".
+        """
+        from .models import LinkCounter
+
+        if not ActivationLinkManager._known_without_pending_verification(user):
+            await LinkCounter.objects.filter(requester=user).adelete()
+
+    @staticmethod
+    def _known_without_pending_verification(user: User) -> bool:
+        """
+        True if the user was fetched with its (missing) counter, so there is nothing to delete.
+        """
+        descriptor = type(user).linkcounter
+        return descriptor.is_cached(user) and descriptor.related.get_cached_value(user) is None
+
     @staticmethod
     def _get_sent_count(user: User):
         """
         Returns the no. of times email has already been sent to a user.
+
+        A user without a counter row has received the first email only
+        (or was sent it before the pending verification rows existed).
         """
-        return int(user.linkcounter.sent_count)
+        try:
+            return int(user.linkcounter.sent_count)
+        except ObjectDoesNotExist:
+            return INITIAL_SENT_COUNT
 
-    @staticmethod
-    def _increment_sent_counter(user: User) -> None:
+    def _increment_sent_counter(self, user: User) -> bool:
         """
-        Increment count by one after resending the verification link.
+        Increment count by one if the user has remaining attempts.
+
+        The check and the increment are a single conditional
+        "UPDATE ... SET sent_count = sent_count + 1 WHERE sent_count < max_retries",
+        so concurrent resend requests can never go past the limit.
+
+        Returns
+        -------
+        bool
+            True if the count was incremented, False if the maximum is reached.
         """
-        user.linkcounter.sent_count += 1
-        user.linkcounter.save()
+        from .models import LinkCounter
+
+        pending_values = self._get_pending_values(user.email)
+
+        def increment():
+            return LinkCounter.objects.filter(
+                requester=user, sent_count__lt=self.max_retries
+            ).update(sent_count=F("sent_count") + 1, **pending_values)
+
+        if increment():
+            return True
+        # either the limit is reached or the counter doesn't exist yet
+        LinkCounter.objects.get_or_create(
+            requester=user,
+            defaults={"sent_count": INITIAL_SENT_COUNT, **pending_values},
+        )
+        return bool(increment())
+
+    async def _aincrement_sent_counter(self, user: User) -> bool:
+        """
+        Async version of "_increment_sent_counter".
+        """
+        from .models import LinkCounter
+
+        pending_values = self._get_pending_values(user.email)
+
+        async def increment():
+            return await LinkCounter.objects.filter(
+                requester=user, sent_count__lt=self.max_retries
+            ).aupdate(sent_count=F("sent_count") + 1, **pending_values)
+
+        if await increment():
+            return True
+        await LinkCounter.objects.aget_or_create(
+            requester=user,
+            defaults={"sent_count": INITIAL_SENT_COUNT, **pending_values},
+        )
+        return bool(await increment())
+
+    def _decrement_sent_counters(self, users) -> None:
+        """
+        Gives back the attempts taken by "_increment_sent_counter" for links that were not sent.
+        """
+        from .models import LinkCounter
+
+        LinkCounter.objects.filter(requester__in=users).update(
+            sent_count=F("sent_count") - 1
+        )
 
     def can_request_new_link(self, user: User) -> bool:
         """
@@ -90,12 +385,16 @@ class ActivationLinkManager(GeneralConfig):
         return True
 
     @staticmethod
-    def generate_link(token, user_email):
+    def generate_link(token, user_email, user=None):
         """
         Generates an email verification link for an inactive user.
 
         This method creates a signed token for the user and encodes the user's email
-        to construct a unique verification link.
+        to construct a unique verification link. If "VERIFY_EMAIL_LINK_FORMAT" is "pk" and the
+        user is given, the link holds the user's primary key instead of the email, so that the
+        user is fetched by primary key. The email is still bound to the token, it is part of the
+        hash made by "default_token_generator". If it is "compact", the token holds everything
+        (see "compact.CompactSigner") and the email segment is only COMPACT_LINK_MARKER.
 
         Parameters
         ----------
@@ -105,32 +404,55 @@ class ActivationLinkManager(GeneralConfig):
             user encrpted encode token
         user_email : str
             The email address of the user, which will be included in the verification link.
+        user : User, optional
+            The user the link is for.
 
         Returns
         -------
         str
             The absolute URL of the verification link.
         """
-        encoded_email = urlsafe_b64encode(str(user_email).encode("utf-8")).decode(
-            "utf-8"
-        )
+        link_format = get_settings().link_format
+        if link_format not in LINK_FORMATS:
+            raise ImproperlyConfigured(
+                f"VERIFY_EMAIL_LINK_FORMAT must be one of {LINK_FORMATS}, got {link_format!r}"
+            )
+        if link_format == "compact":
+            encoded_email = COMPACT_LINK_MARKER
+        elif link_format == "pk" and user is not None:
+            encoded_email = encode_user_pk(user.pk)
+        else:
+            encoded_email = urlsafe_b64encode(str(user_email).encode("utf-8")).decode(
+                "utf-8"
+            )
         return f"/verification/user/verify-email/{encoded_email}/{token}/"
 
-    def get_absolute_verification_url(self, request, token, user_email):
-        return request.build_absolute_uri(self.generate_link(token, user_email))
+    def get_absolute_verification_url(self, request, token, user_email, user=None):
+        return request.build_absolute_uri(self.generate_link(token, user_email, user))
 
     def request_new_link(self, request, inactive_user, token, user_email):
         """
         generate link when user clicks on request new link. Perform several checks and returns either a link or bool
         """
-        if self.can_request_new_link(inactive_user):  # noqa
-            link = self.get_absolute_verification_url(request, token, user_email)
-            self._increment_sent_counter(inactive_user)  # noqa
-            return link
-        else:
+        if not self._increment_sent_counter(inactive_user):
+            raise MaxRetriesExceeded(
+                f"Maximum retries for user with email: {user_email} has been exceeded."
+            )
+        return self.get_absolute_verification_url(
+            request, token, user_email, inactive_user
+        )
+
+    async def arequest_new_link(self, request, inactive_user, token, user_email):
+        """
+        Async version of "request_new_link".
+        """
+        if not await self._aincrement_sent_counter(inactive_user):
             raise MaxRetriesExceeded(
                 f"Maximum retries for user with email: {user_email} has been exceeded."
             )
+        return self.get_absolute_verification_url(
+            request, token, user_email, inactive_user
+        )
 
 
 @dataclass
@@ -156,16 +478,146 @@ class TokenManager(signing.TimestampSigner, GeneralConfig):
     """
 
     safe_url_encoder: SafeURL = field(default_factory=SafeURL)
-    link_manager: ActivationLinkManager = field(default_factory=ActivationLinkManager)
+    link_manager: ActivationLinkManager = field(
+        default_factory=lambda: get_shared_instance(ActivationLinkManager)
+    )
 
     def __post_init__(self):
         GeneralConfig.__post_init__(self)
 
-        self.key = self.settings.get("key", raise_exception=False)
-        self.salt = self.settings.get("salt", raise_exception=False)
-        self.sep = self.settings.get("sep", raise_exception=False)
+        self.key = self.settings.key
+        self.salt = self.settings.salt
+        self.sep = self.settings.sep
 
         signing.TimestampSigner.__init__(self, key=self.key, sep=self.sep, salt=self.salt)
+        self.compact_signer = CompactSigner(
+            self.key, f"verify_email.compact.{self.salt}", self.settings.signing_keys
+        )
+
+    @staticmethod
+    def _get_user_fields():
+        """
+        Returns the user fields needed to check the token and activate the user.
+        """
+        user_model = get_user_model()
+        wanted = {
+            "email",
+            "password",
+            "last_login",
+            "is_active",
+            user_model.USERNAME_FIELD,
+            user_model.get_email_field_name(),
+        }
+        concrete = {user_field.name for user_field in user_model._meta.concrete_fields}
+        return wanted & concrete
+
+    @staticmethod
+    def _get_users_queryset():
+        """
+        Returns the users, joined with their link counter, with only the needed fields loaded.
+        """
+        return (
+            get_user_model()
+            .objects.select_related("linkcounter")
+            .only(
+                *TokenManager._get_user_fields(),
+                "linkcounter__requester",
+                "linkcounter__sent_count",
+            )
+        )
+
+    @staticmethod
+    def _get_verification_querysets(plain_email: str):
+        """
+        Returns the two querysets used to find the user to verify:
+            - its pending verification row (by email digest), joined with the user,
+            - the user itself, joined with its link counter.
+
+        Only the fields needed to check the token and activate the user are loaded.
+        """
+        from .models import LinkCounter
+
+        pending = (
+            LinkCounter.objects.select_related("requester")
+            .only(
+                "requester",
+                "sent_count",
+                *(f"requester__{name}" for name in TokenManager._get_user_fields()),
+            )
+            .filter(email_digest=get_email_digest(plain_email))
+            .order_by("requester_id")
+        )
+        users = TokenManager._get_users_queryset()
+        return pending, filter_users_by_email(plain_email, users)
+
+    @staticmethod
+    def _get_pending_user(pending, plain_email: str) -> Union[User, None]:
+        if pending is None or not emails_match(pending.requester.email, plain_email):
+            return None
+        user = pending.requester
+        user.linkcounter = pending
+        return user
+
+    @staticmethod
+    def _get_user_by_email(plain_email: str) -> Union[User, None]:
+        """
+        Fetches the user to verify, with its link counter, in a single query.
+
+        The user is first looked up through its pending verification row (by email digest),
+        which is a much smaller table than the user table. Users without one, e.g. sent a link
+        before the pending rows existed, are looked up in the user table.
+
+        Returns None if no user has this email.
+        """
+        with get_metrics().timer("db_lookup"):
+            pending, users = TokenManager._get_verification_querysets(plain_email)
+            user = TokenManager._get_pending_user(pending.first(), plain_email)
+            return user if user is not None else users.first()
+
+    @staticmethod
+    async def _aget_user_by_email(plain_email: str) -> Union[User, None]:
+        """
+        Async version of "_get_user_by_email".
+        """
+        with get_metrics().timer("db_lookup"):
+            pending, users = TokenManager._get_verification_querysets(plain_email)
+            user = TokenManager._get_pending_user(await pending.afirst(), plain_email)
+            return user if user is not None else await users.afirst()
+
+    @staticmethod
+    def _get_user_by_pk(pk: str) -> Union[User, None]:
+        """
+        Fetches the user of a link in the "pk" format, with its link counter, in a single query.
+        """
+        with get_metrics().timer("db_lookup"):
+            try:
+                return TokenManager._get_users_queryset().filter(pk=pk).first()
+            except (ValueError, ValidationError):
+                # not a valid primary key for this user model
+                return None
+
+    @staticmethod
+    async def _aget_user_by_pk(pk: str) -> Union[User, None]:
+        """
+        Async version of "_get_user_by_pk".
+        """
+        with get_metrics().timer("db_lookup"):
+            try:
+                return await TokenManager._get_users_queryset().filter(pk=pk).afirst()
+            except (ValueError, ValidationError):
+                return None
+
+    @staticmethod
+    def _get_link_user(target: LinkTarget) -> Union[User, None]:
+        if target.pk is not None:
+            return TokenManager._get_user_by_pk(target.pk)
+        return TokenManager._get_user_by_email(target.email)
+
+    @staticmethod
+    async def _aget_link_user(target: LinkTarget) -> Union[User, None]:
+        if target.pk is not None:
+            return await TokenManager._aget_user_by_pk(target.pk)
+        return await TokenManager._aget_user_by_email(target.email)
 
     @staticmethod
     def is_token_valid(plain_email, encrypted_user_token) -> bool:
@@ -192,92 +644,31 @@ class TokenManager(signing.TimestampSigner, GeneralConfig):
         UserNotFound
             If no user is found with the provided email.
         """
-        inactive_user: list = get_user_model().objects.filter(email=plain_email)
+        inactive_user = TokenManager._get_user_by_email(plain_email)
         encrypted_token = encrypted_user_token.split(":")[0]
 
-        if not inactive_user:
+        if inactive_user is None:
             raise UserNotFound(f"User with {plain_email} not found")
-        inactive_user = inactive_user[0]
-        return default_token_generator.check_token(inactive_user, encrypted_token)
+        return check_user_token(inactive_user, encrypted_token)
 
     # Private :
     def _get_seconds(self, interval):
         """
         Converts a time interval specified in the settings into seconds.
-
-        The interval can be given as an integer (considered in seconds)
-        or as a string with a suffix indicating the unit of time.
-        Supported units are seconds (s), minutes (m), hours (h), and days (d).
-
-        Parameters
-        ----------
-        interval : int or str
-            The time interval to convert. An integer is interpreted as seconds,
-            while a string should end with a time unit suffix.
-
-        Returns
-        -------
-        float
-            The equivalent time in seconds.
-
-        Raises
-        ------
-        WrongTimeInterval
-            If the time is not greater than 0 or if an unsupported time unit is specified.
+        See "app_configurations.get_seconds".
 
         Examples
         --------
         >>> self._get_seconds(10)
-        10.0
+        10
 
         >>> self._get_seconds("5m")
         300.0
 
-        >>> self._get_seconds("1h")
-        3600.0
-
-        >>> self._get_seconds("2d")
-        172800.0
-
-        >>> self._get_seconds("15s")
-        15.0
-
         >>> self._get_seconds("invalid_input")
         WrongTimeInterval: Time unit must be from : ['s', 'm', 'h', 'd']
         """
-        if isinstance(interval, int):
-            return interval
-        if isinstance(interval, str):
-            unit = [i for i in self.time_units if interval.endswith(i)]
-            if not unit:
-                unit = "s"
-                interval += unit
-            else:
-                unit = unit[
-                    0
-                ]  # TODO: look into this, this might cook my ass in some cases
-            try:
-                digit_time = int(interval[:-1])
-                if digit_time <= 0:
-                    raise WrongTimeInterval("Time must be greater than 0")
-
-                if unit == "s":
-                    return digit_time
-                if unit == "m":
-                    return timedelta(minutes=digit_time).total_seconds()
-                if unit == "h":
-                    return timedelta(hours=digit_time).total_seconds()
-                if unit == "d":
-                    return timedelta(days=digit_time).total_seconds()
-                else:
-                    return WrongTimeInterval(
-                        f"Time unit must be from : {self.time_units}"
-                    )
-
-            except ValueError:
-                raise WrongTimeInterval(f"Time unit must be from : {self.time_units}")
-        else:
-            raise WrongTimeInterval(f"Time unit must be from : {self.time_units}")
+        return get_seconds(interval)
 
     def _get_inactive_user_by_email_and_token(
         self, plain_email: str, enc_token: str
@@ -304,13 +695,31 @@ class TokenManager(signing.TimestampSigner, GeneralConfig):
         ------
         InvalidToken
             If the token is invalid for the provided email.
+        UserNotFound
+            If no user is found with the provided email.
         """
-        if not self.is_token_valid(plain_email, enc_token):
-            raise InvalidToken("Token is invalid")
+        return self._check_user_token(
+            self._get_user_by_email(plain_email), plain_email, enc_token
+        )
+
+    async def _aget_inactive_user_by_email_and_token(
+        self, plain_email: str, enc_token: str
+    ) -> User:
+        """
+        Async version of "_get_inactive_user_by_email_and_token".
+        """
+        return self._check_user_token(
+            await self._aget_user_by_email(plain_email), plain_email, enc_token
+        )
 
-        return get_user_model().objects.filter(email=plain_email)[
-            0
-        ]  # this list will always have a value
+    @staticmethod
+    def _check_user_token(inactive_user, plain_email: str, enc_token: str) -> User:
+        if inactive_user is None:
+            raise UserNotFound(f"User with {plain_email} not found")
+
+        if not check_user_token(inactive_user, enc_token):
+            raise InvalidToken("Token is invalid")
+        return inactive_user
 
     def _decrypt_expired_user(self, expired_token):
         """
@@ -337,6 +746,8 @@ class TokenManager(signing.TimestampSigner, GeneralConfig):
 
         If "EXPIRE_AFTER" is specified in settings, a timestamped token is created.
         Otherwise, an encrypted token without a timestamp is generated.
+        With "VERIFY_EMAIL_LINK_FORMAT" = "compact", a compact token is returned, it is
+        always timestamped and already URL safe.
 
         Parameters
         ----------
@@ -350,15 +761,118 @@ class TokenManager(signing.TimestampSigner, GeneralConfig):
         str
             The signed and encrypted, URL encoded, token for the user.
         """
-        user_token = default_token_generator.make_token(user)
+        with get_metrics().timer("token_generate"):
+            if self.settings.link_format == "compact":
+                return self.compact_signer.make_token(user)
+            user_token = default_token_generator.make_token(user)
+            if self.max_age:
+                user_token = self.sign(user_token)
+            return (
+                self.safe_url_encoder.perform_encoding(user_token)
+                if get_url_encoded
+                else user_token
+            )
+
+    def generate_tokens_for_users(
+        self, users: Iterable[User], base_url: Optional[str] = None
+    ) -> Iterator[Tuple[User, str, str]]:
+        """
+        Generates the tokens and links of many users, lazily.
+
+        The result is the same as calling "generate_token_for_user" and "generate_link" for each
+        user, but the HMAC keys of the token generator and of the signer are derived once for
+        the whole batch, so users can be streamed from a queryset iterator in constant memory.
+
+        Parameters
+        ----------
+        users : iterable of User
+        base_url : str, optional
+            Prepended to the links, e.g. "https://example.com", otherwise the links are relative.
+
+        Yields
+        ------
+        tuple
+            (user, URL encoded token, link)
+        """
+        if self.settings.link_format == "compact":
+            make_token = self.compact_signer.make_token
+        else:
+            make_token = self._get_batch_token_maker()
+        prefix = base_url.rstrip("/") if base_url else ""
+        metrics = get_metrics()
+
+        for user in users:
+            with metrics.timer("token_generate"):
+                token = make_token(user)
+            link = self.link_manager.generate_link(
+                token, getattr(user, user.get_email_field_name()), user
+            )
+            yield user, token, prefix + link
+
+    def _get_batch_token_maker(self):
+        """
+        Returns a function making the same tokens as "generate_token_for_user", with the HMAC keys
+        of "default_token_generator" and of the signer derived once.
+
+        The first token is checked with "default_token_generator.check_token" and "unsign": if
+        it doesn't pass (the mirrored Django internals changed), an error is logged and every
+        token is made by "generate_token_for_user" instead.
+        """
+        make_batch_token = self._make_batch_token_function()
+        checked = False
+
+        def make_token(user):
+            nonlocal checked, make_batch_token
+            token = make_batch_token(user)
+            if not checked:
+                checked = True
+                if not self._is_valid_batch_token(user, token):
+                    logger.error(
+                        "Batch tokens don't match the ones of generate_token_for_user, "
+                        "falling back to generating them one by one"
+                    )
+                    make_batch_token = self.generate_token_for_user
+                    token = make_batch_token(user)
+            return token
+
+        return make_token
+
+    def _is_valid_batch_token(self, user: User, token: str) -> bool:
+        user_token = self.safe_url_encoder.perform_decoding(token)
+        if not user_token:
+            return False
         if self.max_age:
-            user_token = self.sign(user_token)
-        return (
-            self.safe_url_encoder.perform_encoding(user_token)
-            if get_url_encoded
-            else user_token
+            try:
+                user_token = self.unsign(user_token, self.max_age)
+            except signing.BadSignature:
+                return False
+        return default_token_generator.check_token(user, user_token)
+
+    def _make_batch_token_function(self):
+        # mirrors PasswordResetTokenGenerator._make_token_with_timestamp and
+        # TimestampSigner.sign (salted HMAC keyed on salt + "signer") of Django 4.2 to 5.2,
+        # "_get_batch_token_maker" checks the result against the real implementations, and
+        # "test_generate_tokens_for_users_mirrors_installed_django" fails when they change
+        generator = default_token_generator
+        token_hmac = _SaltedHMAC(generator.key_salt, generator.secret, generator.algorithm)
+        signer_hmac = (
+            _SaltedHMAC(self.salt + "signer", self.key, self.algorithm)
+            if self.max_age
+            else None
         )
 
+        def make_token(user):
+            timestamp = generator._num_seconds(generator._now())
+            hash_string = token_hmac(generator._make_hash_value(user, timestamp))
+            user_token = f"{int_to_base36(timestamp)}-{hash_string.hexdigest()[::2]}"
+            if signer_hmac is not None:
+                value = f"{user_token}{self.sep}{self.timestamp()}"
+                signature = signing.b64_encode(signer_hmac(value).digest()).decode()
+                user_token = f"{value}{self.sep}{signature}"
+            return self.safe_url_encoder.perform_encoding(user_token)
+
+        return make_token
+
     @staticmethod
     def get_user_by_token(plain_email, encrypted_token):
         """
@@ -369,20 +883,48 @@ class TokenManager(signing.TimestampSigner, GeneralConfig):
             - InvalidToken
             - UserNotFound
         """
-        inactive_users = get_user_model().objects.filter(email=plain_email)
-        encrypted_token = encrypted_token.split(":")[0]
-        for unique_user in inactive_users:
-            valid = default_token_generator.check_token(unique_user, encrypted_token)
-            if valid:
-                if unique_user.is_active:
-                    raise UserAlreadyActive(
-                        f"The user with email: {plain_email} is already active"
-                    )
-                return unique_user
-            else:
-                raise InvalidToken("Token is invalid")
-        else:
+        return TokenManager._check_user_token_for_resend(
+            filter_users_by_email(plain_email).first(), plain_email, encrypted_token
+        )
+
+    @staticmethod
+    async def aget_user_by_token(plain_email, encrypted_token):
+        """
+        Async version of "get_user_by_token".
+        """
+        return TokenManager._check_user_token_for_resend(
+            await filter_users_by_email(plain_email).afirst(),
+            plain_email,
+            encrypted_token,
+        )
+
+    @staticmethod
+    def get_user_by_pk_and_token(pk, encrypted_token):
+        """
+        Same as "get_user_by_token" for links in the "pk" format.
+        """
+        return TokenManager._check_user_token_for_resend(
+            TokenManager._get_user_by_pk(pk), LinkTarget(pk=pk), encrypted_token
+        )
+
+    @staticmethod
+    async def aget_user_by_pk_and_token(pk, encrypted_token):
+        """
+        Async version of "get_user_by_pk_and_token".
+        """
+        return TokenManager._check_user_token_for_resend(
+            await TokenManager._aget_user_by_pk(pk), LinkTarget(pk=pk), encrypted_token
+        )
+
+    @staticmethod
+    def _check_user_token_for_resend(user, plain_email, encrypted_token):
+        if user is None:
             raise UserNotFound(f"User with {plain_email} not found")
+        if not check_user_token(user, encrypted_token):
+            raise InvalidToken("Token is invalid")
+        if user.is_active:
+            raise UserAlreadyActive(f"The user with email: {plain_email} is already active")
+        return user
 
     def decrypt_token_and_get_user(
         self,
@@ -427,11 +969,57 @@ class TokenManager(signing.TimestampSigner, GeneralConfig):
         - If the `max_age` (token timeout) is enabled, token expiration is checked.
         - Logs critical, warning, or error messages depending on the error encountered.
         """
-        decoded_email = self.safe_url_encoder.perform_decoding(encoded_email)
-        decoded_token = self.safe_url_encoder.perform_decoding(encoded_token)
+        target, user_token, expired = self._decode_link(encoded_email, encoded_token)
+        try:
+            user = self._check_user_token(
+                self._get_link_user(target), target, user_token
+            )
+        except UserNotFound:
+            logger.error("User with the given email not found in db")
+            raise
+        return self._check_expired_link(user, expired)
+
+    async def adecrypt_token_and_get_user(
+        self,
+        encoded_email: str,
+        encoded_token: str,
+    ) -> Union[User, None]:
+        """
+        Async version of "decrypt_token_and_get_user", the user is fetched with the async ORM.
+        """
+        target, user_token, expired = self._decode_link(encoded_email, encoded_token)
+        try:
+            user = self._check_user_token(
+                await self._aget_link_user(target), target, user_token
+            )
+        except UserNotFound:
+            logger.error("User with the given email not found in db")
+            raise
+        return self._check_expired_link(user, expired)
+
+    def _decode_link(self, encoded_email: str, encoded_token: str):
+        """
+        Decodes the email and token of a link and checks the token signature.
+
+        Returns
+        -------
+        tuple
+            (LinkTarget, user token, SignatureExpired error if the link is expired else None).
+            An expired token is still unsigned, so that the user can be looked up to request a new link.
+
+        Raises
+        ------
+        DecodingFailed, signing.BadSignature
+        """
+        if encoded_email == COMPACT_LINK_MARKER:
+            return self._decode_compact_link(encoded_token)
+
+        with get_metrics().timer("token_decode"):
+            target = decode_link_target(encoded_email)
+            decoded_token = self.safe_url_encoder.perform_decoding(encoded_token)
 
         # Check if decoding was successful
-        if not decoded_email or not decoded_token:
+        if not target or not decoded_token:
             logger.error(
                 f'\n{"~" * 40}\nError occurred in decoding the link!'
                 f' Either link or email could not be decoded\n{"~" * 40}\n'
@@ -440,32 +1028,61 @@ class TokenManager(signing.TimestampSigner, GeneralConfig):
 
         # Token timeout check
         if not self.max_age:
-            return self._get_inactive_user_by_email_and_token(
-                decoded_email, decoded_token
-            )
+            return target, decoded_token, None
         try:
-            alive_time = self._get_seconds(self.max_age)
-            user_token = self.unsign(decoded_token, alive_time)
-            # Retrieve the user if valid
-            return self._get_inactive_user_by_email_and_token(decoded_email, user_token)
+            with get_metrics().timer("signer_unsign"):
+                user_token = self.unsign(decoded_token, self.max_age)
+            return target, user_token, None
 
-        except UserNotFound:
-            logger.error("User with the given email not found in db")
-            raise
-
-        except signing.SignatureExpired:
+        except signing.SignatureExpired as expired:
             logger.warning(
                 f'\n{"~" * 40}\n[WARNING] : The link is Expired!\n{"~" * 40}\n'
             )
-            user = self._get_inactive_user_by_email_and_token(
-                decoded_email, self._decrypt_expired_user(decoded_token)
+            return target, self._decrypt_expired_user(decoded_token), expired
+
+        except signing.BadSignature:
+            logger.critical(
+                f'\n{"~" * 40}\n[CRITICAL] : X_x --> CAUTION : LINK SIGNATURE ALTERED! <-- x_X\n{"~" * 40}\n'
             )
-            if not self.link_manager.can_request_new_link(user):
-                raise MaxRetriesExceeded()
             raise
 
+    def _decode_compact_link(self, encoded_token: str):
+        """
+        Same as "_decode_link" for links in the "compact" format: a single base64 decoding and
+        a single HMAC, the returned token is the parsed CompactToken.
+        """
+        try:
+            with get_metrics().timer("token_decode"):
+                token = self.compact_signer.parse(encoded_token)
+        except DecodingFailed:
+            logger.error(
+                f'\n{"~" * 40}\nError occurred in decoding the link!'
+                f' The compact token could not be decoded\n{"~" * 40}\n'
+            )
+            raise
         except signing.BadSignature:
             logger.critical(
                 f'\n{"~" * 40}\n[CRITICAL] : X_x --> CAUTION : LINK SIGNATURE ALTERED! <-- x_X\n{"~" * 40}\n'
             )
             raise
+
+        expired = None
+        age = token.age()
+        if self.max_age and age > self.max_age:
+            logger.warning(
+                f'\n{"~" * 40}\n[WARNING] : The link is Expired!\n{"~" * 40}\n'
+            )
+            expired = signing.SignatureExpired(
+                f"Signature age {age} > {self.max_age} seconds"
+            )
+        return LinkTarget(pk=token.pk), token, expired
+
+    def _check_expired_link(self, user: User, expired) -> User:
+        """
+        Raises MaxRetriesExceeded or the SignatureExpired error if the link is expired.
+        """
+        if expired is None:
+            return user
+        if not self.link_manager.can_request_new_link(user):
+            raise MaxRetriesExceeded()
+        raise expired
@@ -1,20 +1,39 @@
 from django.urls import path
-from .views import verify_and_activate_user, request_new_link
+
+from .app_configurations import get_settings
+from .views import (
+    metrics_view,
+    request_new_link,
+    request_new_link_async,
+    verify_and_activate_user,
+    verify_and_activate_user_async,
+)
+
+async_views = get_settings().async_views
+verify_view = (
+    verify_and_activate_user_async if async_views else verify_and_activate_user
+)
+request_new_link_view = request_new_link_async if async_views else request_new_link
 
 urlpatterns = [
     path(
         "user/verify-email/<user_email>/<user_token>/",
-        verify_and_activate_user,
+        verify_view,
         name="verify-email",
     ),
     path(
         "user/verify-email/request-new-link/<user_email>/<user_token>/",
-        request_new_link,
+        request_new_link_view,
         name="request-new-link-from-token",
     ),
     path(
         "user/verify-email/request-new-link/",
-        request_new_link,
+        request_new_link_view,
         name="request-new-link-from-email",
     ),
 ]
+
+if get_settings().metrics_view:
+    urlpatterns.append(
+        path("user/verify-email/metrics/", metrics_view, name="verify-email-metrics")
+    )
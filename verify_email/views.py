@@ -1,42 +1,43 @@
 import logging
+import math
 
+from asgiref.sync import sync_to_async
 from django.http import Http404, HttpResponse
 from django.urls import reverse
 from django.shortcuts import render, redirect
-from django.contrib.auth import get_user_model
 from django.contrib import messages
 from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
 from django.core.signing import SignatureExpired, BadSignature
 from django.views.decorators.http import require_GET, require_POST
 
 
-from .app_configurations import GetFieldFromSettings
+from .app_configurations import get_settings
 from .confirm import UserActivationProcess
 from .email_handler import ActivationMailManager
 from .forms import RequestNewVerificationEmail
+from .link_cache import (
+    aget_link_state,
+    amark_link_consumed,
+    aremember_bad_link,
+    get_link_digest,
+    get_link_state,
+    mark_link_consumed,
+    remember_bad_link,
+)
+from .metrics import get_metrics
+from .pages import render_form_page, render_static_page
+from .ratelimit import alimit_client, alimit_email, limit_client, limit_email
+from .token_manager import aget_link_email, filter_users_by_email, get_link_email
 from .errors import (
     InvalidToken,
     MaxRetriesExceeded,
+    RateLimited,
     UserAlreadyActive,
     UserNotFound,
 )
 
 logger = logging.getLogger(__name__)
 
-pkg_configs = GetFieldFromSettings()
-
-login_page = pkg_configs.get("login_page")
-
-success_msg = pkg_configs.get("verification_success_msg")
-failed_msg = pkg_configs.get("verification_failed_msg")
-debug = pkg_configs.get("debug")
-
-failed_template = pkg_configs.get("verification_failed_template")
-success_template = pkg_configs.get("verification_success_template")
-link_expired_template = pkg_configs.get("link_expired_template")
-request_new_email_template = pkg_configs.get("request_new_email_template")
-new_email_sent_template = pkg_configs.get("new_email_sent_template")
-
 
 @require_GET
 def verify_and_activate_user(request, user_email, user_token):
@@ -46,43 +47,111 @@ def verify_and_activate_user(request, user_email, user_token):
 
     verify the user's email and token and redirect'em accordingly.
     """
-    try:
-        verified_activated_user = UserActivationProcess.activate_user(
-            user_email, user_token
-        )
-        if login_page and not success_template:
-            messages.success(request, success_msg)
-            return redirect(to=login_page)
+    config = get_settings()
+    link_digest = get_link_digest(user_email, user_token)
+    consumed, error = get_link_state(link_digest)
+    if consumed:
+        return _already_verified_response(request, config)
+    if error is None:
+        try:
+            UserActivationProcess.activate_user(user_email, user_token)
+        except Exception as activation_error:
+            error = activation_error
+            remember_bad_link(link_digest, error)
+        else:
+            mark_link_consumed(link_digest)
+            return _verification_successful_response(request, config)
+    return _verification_failed_response(
+        request, config, error, user_email, user_token
+    )
+
+
+@require_GET
+async def verify_and_activate_user_async(request, user_email, user_token):
+    """
+    Async version of "verify_and_activate_user", used when "VERIFY_EMAIL_ASYNC_VIEWS" is True.
+    The user is fetched and activated with the async ORM, only the response is rendered in a thread.
+    """
+    config = get_settings()
+    link_digest = get_link_digest(user_email, user_token)
+    consumed, error = await aget_link_state(link_digest)
+    if consumed:
+        return await sync_to_async(_already_verified_response)(request, config)
+    if error is None:
+        try:
+            await UserActivationProcess.aactivate_user(user_email, user_token)
+        except Exception as activation_error:
+            error = activation_error
+            await aremember_bad_link(link_digest, error)
+        else:
+            await amark_link_consumed(link_digest)
+            return await sync_to_async(_verification_successful_response)(
+                request, config
+            )
+    return await sync_to_async(_verification_failed_response)(
+        request, config, error, user_email, user_token
+    )
 
-        return render(
-            request,
-            template_name=success_template,
-            context={
-                "msg": success_msg,
-                "status": f"Verification Successful!",
-                "link": reverse(login_page),
-            },
-        )
 
+def _verification_successful_response(request, config):
+    get_metrics().increment("verification", outcome="success")
+    if config.login_page and not config.verification_success_template:
+        messages.success(request, config.verification_success_msg)
+        return redirect(to=config.login_page)
+
+    return render(
+        request,
+        template_name=config.verification_success_template,
+        context={
+            "msg": config.verification_success_msg,
+            "status": f"Verification Successful!",
+            "link": reverse(config.login_page),
+        },
+    )
+
+
+def _already_verified_response(request, config):
+    get_metrics().increment("verification", outcome="already_verified")
+    msg = "Your email is already verified."
+    if config.login_page and not config.verification_success_template:
+        messages.info(request, msg)
+        return redirect(to=config.login_page)
+
+    return render_static_page(
+        request,
+        template_name=config.verification_success_template,
+        context={
+            "msg": msg,
+            "status": "Already Verified!",
+            "link": reverse(config.login_page),
+        },
+    )
+
+
+def _verification_failed_response(request, config, error, user_email, user_token):
+    try:
+        raise error
     except (ValueError, TypeError) as error:
+        get_metrics().increment("verification", outcome="failed")
         logger.error(
             f"[ERROR]: Something went wrong while verifying user, exception: {error}"
         )
-        return render(
+        return render_static_page(
             request,
             status=401,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
-                "msg": failed_msg,
+                "msg": config.verification_failed_msg,
                 "minor_msg": "There is something wrong with this link...",
                 "status": "Verification Failed!",
             },
         )
     except SignatureExpired:
+        get_metrics().increment("verification", outcome="expired")
         return render(
             request,
             status=401,
-            template_name=link_expired_template,
+            template_name=config.link_expired_template,
             context={
                 "msg": "The link has lived its life :( Request a new one!",
                 "status": "Expired!",
@@ -91,10 +160,11 @@ def verify_and_activate_user(request, user_email, user_token):
             },
         )
     except BadSignature:
-        return render(
+        get_metrics().increment("verification", outcome="bad_signature")
+        return render_static_page(
             request,
             status=401,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
                 "msg": "This link was modified before verification.",
                 "minor_msg": "Cannot request another verification link with faulty link.",
@@ -102,40 +172,44 @@ def verify_and_activate_user(request, user_email, user_token):
             },
         )
     except MaxRetriesExceeded:
-        return render(
+        get_metrics().increment("verification", outcome="max_retries")
+        return render_static_page(
             request,
             status=401,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
                 "msg": "You have exceeded the maximum verification requests! Contact admin.",
                 "status": "Maxed out!",
             },
         )
     except InvalidToken:
-        return render(
+        get_metrics().increment("verification", outcome="invalid")
+        return render_static_page(
             request,
             status=401,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
                 "msg": "This link is invalid or been used already, we cannot verify using this link.",
                 "status": "Invalid Link",
             },
         )
     except UserNotFound:
+        get_metrics().increment("verification", outcome="not_found")
         raise Http404("404 User not found")
 
     except Exception as err:
+        get_metrics().increment("verification", outcome="failed")
         logger.exception(err)
         flash_msg = "Something went wrong during this process!"
-        if debug:
+        if config.debug:
             flash_msg = f"""{flash_msg} Developer should look into this.
             Error Details: {err}
             (You are seeing error details because app is running in debug mode)
             """
-        return render(
+        return render_static_page(
             request,
             status=403,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
                 "msg": flash_msg,
                 "status": "Failed!",
@@ -143,18 +217,20 @@ def verify_and_activate_user(request, user_email, user_token):
         )
 
 
-
 def request_new_link(request, user_email=None, user_token=None):
+    config = get_settings()
     try:
         if user_email is None or user_token is None:
             # request came from re-request email page
             if request.method == "POST":
+                limit_client(request)
                 form = RequestNewVerificationEmail(request.POST)  # do not inflate data
                 if form.is_valid():
                     form_data: dict = form.cleaned_data
                     email = form_data["email"]
+                    limit_email(email)
 
-                    inactive_user = get_user_model().objects.get(email=email)
+                    inactive_user = filter_users_by_email(email).get()
                     if inactive_user.is_active:
                         raise UserAlreadyActive("User is already active")
                     else:
@@ -162,100 +238,189 @@ def request_new_link(request, user_email=None, user_token=None):
                         ActivationMailManager.resend_verification_link(
                             request, email, user=inactive_user, encoded=False
                         )
-                        return render(
-                            request,
-                            template_name=new_email_sent_template,
-                            context={
-                                "msg": "You have requested another verification email!",
-                                "minor_msg": "Your verification link has been sent",
-                                "status": "Email Sent!",
-                            },
-                        )
+                        return _new_email_sent_response(request, config)
             else:
-                form = RequestNewVerificationEmail()
+                return render_form_page(
+                    request,
+                    config.request_new_email_template,
+                    {"form": RequestNewVerificationEmail()},
+                )
             return render(
                 request,
-                template_name=request_new_email_template,
+                template_name=config.request_new_email_template,
                 context={"form": form},
             )
         else:
             # request came from  previously sent link
+            limit_client(request)
+            limit_email(get_link_email(user_email, user_token))
             status = ActivationMailManager.resend_verification_link(
                 request, user_email, token=user_token
             )
             if status:
-                return render(
-                    request,
-                    template_name=new_email_sent_template,
-                    context={
-                        "msg": "You have requested another verification email!",
-                        "minor_msg": "Your verification link has been sent",
-                        "status": "Email Sent!",
-                    },
-                )
+                return _new_email_sent_response(request, config)
             else:
                 messages.info(request, "Something went wrong during sending email :(")
                 logger.error("something went wrong during sending email")
 
+    except Exception as error:
+        return _request_new_link_failed_response(request, config, error)
+
+
+async def request_new_link_async(request, user_email=None, user_token=None):
+    """
+    Async version of "request_new_link", used when "VERIFY_EMAIL_ASYNC_VIEWS" is True.
+    """
+    config = get_settings()
+    try:
+        if user_email is None or user_token is None:
+            # request came from re-request email page
+            if request.method == "POST":
+                await alimit_client(request)
+                form = RequestNewVerificationEmail(request.POST)  # do not inflate data
+                if form.is_valid():
+                    email = form.cleaned_data["email"]
+                    await alimit_email(email)
+
+                    inactive_user = await filter_users_by_email(email).aget()
+                    if inactive_user.is_active:
+                        raise UserAlreadyActive("User is already active")
+                    await ActivationMailManager.aresend_verification_link(
+                        request, email, user=inactive_user, encoded=False
+                    )
+                    return await sync_to_async(_new_email_sent_response)(
+                        request, config
+                    )
+            else:
+                return await sync_to_async(render_form_page)(
+                    request,
+                    config.request_new_email_template,
+                    {"form": RequestNewVerificationEmail()},
+                )
+            return await sync_to_async(render)(
+                request,
+                template_name=config.request_new_email_template,
+                context={"form": form},
+            )
+        else:
+            # request came from  previously sent link
+            await alimit_client(request)
+            await alimit_email(await aget_link_email(user_email, user_token))
+            await ActivationMailManager.aresend_verification_link(
+                request, user_email, token=user_token
+            )
+            return await sync_to_async(_new_email_sent_response)(request, config)
+
+    except Exception as error:
+        return await sync_to_async(_request_new_link_failed_response)(
+            request, config, error
+        )
+
+
+def _new_email_sent_response(request, config):
+    get_metrics().increment("resend", outcome="sent")
+    return render_static_page(
+        request,
+        template_name=config.new_email_sent_template,
+        context={
+            "msg": "You have requested another verification email!",
+            "minor_msg": "Your verification link has been sent",
+            "status": "Email Sent!",
+        },
+    )
+
+
+def _request_new_link_failed_response(request, config, error):
+    try:
+        raise error
+    except RateLimited as error:
+        get_metrics().increment("resend", outcome="rate_limited")
+        logger.warning(f"[WARNING]: Request new link rate limited: {error}")
+        response = HttpResponse(b"Too many requests!", status=429)
+        response["Retry-After"] = str(math.ceil(error.retry_after))
+        return response
+
     except ObjectDoesNotExist as error:
+        get_metrics().increment("resend", outcome="not_found")
         messages.warning(request, "User not found associated with given email!")
         logger.error(f"[ERROR]: User not found. exception: {error}")
         return HttpResponse(b"User Not Found", status=404)
 
     except MultipleObjectsReturned as error:
+        get_metrics().increment("resend", outcome="failed")
         logger.error(f"[ERROR]: Multiple users found. exception: {error}")
         return HttpResponse(b"Internal server error!", status=500)
 
     except KeyError as error:
+        get_metrics().increment("resend", outcome="failed")
         logger.error(f"[ERROR]: Key error for email in your form: {error}")
         return HttpResponse(b"Internal server error!", status=500)
 
     except MaxRetriesExceeded as error:
+        get_metrics().increment("resend", outcome="max_retries")
         logger.error(
             f"[ERROR]: Maximum retries for link has been reached. exception: {error}"
         )
-        return render(
+        return render_static_page(
             request,
             status=403,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
                 "msg": "You have exceeded the maximum verification requests! Contact admin.",
                 "status": "Maxed out!",
             },
         )
     except InvalidToken:
-        return render(
+        get_metrics().increment("resend", outcome="invalid")
+        return render_static_page(
             request,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
                 "msg": "This link is invalid or been used already, we cannot verify using this link.",
                 "status": "Invalid Link",
             },
         )
     except UserAlreadyActive:
-        return render(
+        get_metrics().increment("resend", outcome="already_active")
+        return render_static_page(
             request,
             status=403,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
                 "msg": "This user's account is already active",
                 "status": "Already Verified!",
             },
         )
     except Exception as err:
+        get_metrics().increment("resend", outcome="failed")
         logger.exception(err)
         flash_msg = "Something went wrong during this process!"
-        if debug:
+        if config.debug:
             flash_msg = f"""{flash_msg} Developer should look into this.
             Error Details: {err}
             (You are seeing error details because app is running in debug mode)
             """
-        return render(
+        return render_static_page(
             request,
             status=403,
-            template_name=failed_template,
+            template_name=config.verification_failed_template,
             context={
                 "msg": flash_msg,
                 "status": "Failed!",
             },
         )
+
+
+@require_GET
+def metrics_view(request):
+    """
+    Exposes the metrics of the in-memory backend in the Prometheus text format,
+    routed when "VERIFY_EMAIL_METRICS_VIEW" is True.
+    """
+    backend = get_metrics()
+    if not get_settings().metrics_view or not hasattr(backend, "render_prometheus"):
+        raise Http404("Metrics are not exported")
+    return HttpResponse(
+        backend.render_prometheus(),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )